@@ -0,0 +1,55 @@
+#!/usr/bin/env python2
+# DirLister.py  -*- python -*-
+# Copyright (c) 2013 Ross Biro
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+"""DirLister turns a shadow directory into the listing readdir returns.
+
+It makes one pass over the directory, skipping the names that can't
+come from the mount (.git and friends) and unescaping the rest.  The
+scandir package is used when it is installed since it doesn't build the
+whole name list up front, otherwise os.listdir does the job.
+
+listEntries keeps the shadow name next to each name, for callers that
+go on to stat the entries.
+"""
+
+import os
+
+from gitfs.GitFSBase import unescapeName, validName
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def shadowNames(path):
+    if scandir is None:
+        return os.listdir(path)
+    return (entry.name for entry in scandir(path))
+
+def listEntries(path):
+    """Return (name, shadow name) for everything in path the mount shows."""
+    return [(unescapeName(name), name) for name in shadowNames(path) if validName(name)]
+
+def listDirectory(path):
+    names = ['.', '..']
+    names.extend([unescapeName(name) for name in shadowNames(path) if validName(name)])
+    return names
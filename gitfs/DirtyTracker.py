@@ -0,0 +1,99 @@
+#!/usr/bin/env python2
+# DirtyTracker.py  -*- python -*-
+# Copyright (c) 2013 Ross Biro
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+"""DirtyTracker remembers which paths have changed since the last sync
+and decides when the next sync should happen.
+
+Marking a path only adds it to a set and updates a couple of times, so
+it is cheap enough to do on every write.  A single scheduler thread
+that lives as long as the tracker calls the sync callback once nothing
+has changed for the quiet period, or once the oldest change has waited
+max_delay seconds, whichever comes first.
+"""
+
+import logging
+
+from threading import Condition, Lock, Thread
+from time import time
+
+
+class DirtyTracker(object):
+    def __init__(self, callback, quiet=10, max_delay=5*60):
+        self.callback = callback
+        self.quiet = quiet
+        self.max_delay = max_delay
+        self.paths = set()
+        self.lock = Lock()
+        self.wakeup = Condition(self.lock)
+        self.first = None  # when the oldest unsynced change happened.
+        self.last = None   # when the newest one happened.
+        self.halt = False
+        self.thread = Thread(target=self._schedule, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def mark(self, path=None):
+        """Record a change.  path may be None when we just need another sync."""
+        with self.lock:
+            if path is not None:
+                self.paths.add(path)
+            self.last = time()
+            if self.first is None:
+                self.first = self.last
+                self.wakeup.notify()
+
+    def take(self):
+        """Return the changed paths and start collecting a new set."""
+        with self.lock:
+            paths = self.paths
+            self.paths = set()
+            return paths
+
+    def restore(self, paths):
+        """Put back paths from take() that didn't make it into a sync."""
+        with self.lock:
+            self.paths.update(paths)
+
+    def stop(self):
+        with self.lock:
+            self.halt = True
+            self.wakeup.notify()
+
+    def _schedule(self):
+        with self.lock:
+            while not self.halt:
+                if self.first is None:
+                    self.wakeup.wait()
+                    continue
+
+                due = min(self.last + self.quiet, self.first + self.max_delay)
+                now = time()
+                if now < due:
+                    self.wakeup.wait(due - now)
+                    continue
+
+                self.first = None
+                self.last = None
+                # don't hold the lock while the callback runs, writers would stall.
+                self.lock.release()
+                try:
+                    self.callback()
+                except Exception as e:
+                    logging.debug('DirtyTracker callback threw %s', e)
+                finally:
+                    self.lock.acquire()
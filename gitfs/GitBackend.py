@@ -0,0 +1,274 @@
+#!/usr/bin/env python2
+# GitBackend.py  -*- python -*-
+# Copyright (c) 2013 Ross Biro
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+"""A GitBackend is how GitRepo reads and writes the repository in the
+shadow directory: refs, objects, the index and the diffs between trees.
+
+CLIBackend runs git for each of them.  That's always there, but every
+call pays for starting git, finding the repository and usually loading
+the index.
+
+DulwichBackend keeps the repository open with dulwich, when it's
+installed, and reads refs and objects, writes blobs and commits and
+moves refs in process, so none of those start anything.  The index
+stays with git: update-index and write-tree are C, and git keeps the
+trees it wrote last time in the index so write-tree only hashes the
+directories that changed.  dulwich writes the index in python and
+without those trees, which for a big repository costs more than the
+processes it saves.  Diffs between trees stay with git for the same
+reason.  Those all fall through to CLIBackend.
+
+Talking to remotes (pull, push) stays with the git command line either
+way.
+"""
+
+import errno
+import logging
+import os
+import re
+
+from subprocess import PIPE, CalledProcessError, Popen, call, check_output
+from tempfile import TemporaryFile
+from time import altzone, daylight, localtime, time, timezone
+
+try:
+    from dulwich.objects import Blob, Commit
+    from dulwich.repo import Repo, get_user_identity
+except ImportError:
+    Repo = None
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class CLIBackend(object):
+    name = 'cli'
+
+    # paths per git ls-files, well inside any command line limit.
+    stage_chunk = 1000
+
+    def __init__(self, path):
+        self.path = path
+        # the path the last stagePaths that failed was stopped by, if git said.
+        self.rejected = None
+
+    def _git(self, *args):
+        return check_output(('git',) + args, cwd=self.path)
+
+    def readRef(self, name):
+        """The commit name points at, or None if it doesn't exist."""
+        try:
+            return self._git('rev-parse', '--verify', '-q', name).strip()
+        except CalledProcessError:
+            return None
+
+    def head(self):
+        return self.readRef('HEAD')
+
+    def treeOf(self, commit):
+        return self._git('rev-parse', commit + '^{tree}').strip()
+
+    def readBlob(self, sha):
+        return self._git('cat-file', 'blob', sha)
+
+    def writeBlob(self, data):
+        proc = Popen(['git', 'hash-object', '-w', '--stdin'], cwd=self.path, stdin=PIPE, stdout=PIPE)
+        return proc.communicate(data)[0].strip()
+
+    def stagePaths(self, paths):
+        """Stage exactly these paths, whether they were added, changed,
+        removed or turned from a file into a directory or back, with one
+        git update-index.  A directory covers everything under it.  Returns
+        False if it didn't work, with the path git stopped at in rejected
+        when it said which."""
+        self.rejected = None
+        if len(paths) == 0:
+            return True
+        files = []
+        # directories, and paths that are gone and might have been directories.
+        trees = []
+        for path in paths:
+            full = os.path.join(self.path, path)
+            if not os.path.lexists(full) or (os.path.isdir(full) and not os.path.islink(full)):
+                trees.append(path)
+            else:
+                files.append(path)
+        files = self.notIgnored(files)
+        if files is None:
+            return False
+
+        ok = True
+        # a file, not a pipe, so update-index can't block on stderr while
+        # we block feeding it paths.
+        errors = TemporaryFile()
+        updater = Popen(['git', 'update-index', '--add', '--remove', '--replace', '-z', '--stdin'],
+                        cwd=self.path, stdin=PIPE, stderr=errors)
+        try:
+            try:
+                for path in files:
+                    updater.stdin.write(path + '\0')
+                updater.stdin.flush()
+                # git lists what is in the index under each tree, and what is new
+                # and not ignored, straight into update-index.  The index goes
+                # first, so a file that is now a directory is removed before the
+                # files under it are added.
+                for chunk in chunks(trees, self.stage_chunk):
+                    for listing in (['--cached'], ['--others', '--exclude-standard']):
+                        ok = call(['git', '--literal-pathspecs', 'ls-files', '-z'] + listing + ['--'] + chunk,
+                                  cwd=self.path, stdout=updater.stdin) == 0 and ok
+            finally:
+                updater.stdin.close()
+        except IOError as e:
+            # update-index gave up on a path and quit without reading the rest.
+            if e.errno != errno.EPIPE:
+                raise
+            ok = False
+        finally:
+            ok = updater.wait() == 0 and ok
+        if not ok:
+            errors.seek(0)
+            self.rejected = self.rejectedPath(errors.read())
+        errors.close()
+        return ok
+
+    def rejectedPath(self, stderr):
+        """The path update-index died on, out of what it printed."""
+        found = re.search(r'^fatal: Unable to process path (.*)$', stderr, re.MULTILINE)
+        if found is None:
+            return None
+        return found.group(1)
+
+    def notIgnored(self, paths):
+        """paths minus the untracked ones .gitignore says to leave alone,
+        or None if git couldn't tell us."""
+        if len(paths) == 0:
+            return paths
+        proc = Popen(['git', 'check-ignore', '-z', '--stdin'], cwd=self.path, stdin=PIPE, stdout=PIPE)
+        out = proc.communicate(''.join([path + '\0' for path in paths]))[0]
+        # 1 means none of them are ignored.
+        if proc.returncode not in (0, 1):
+            return None
+        ignored = set(out.split('\0'))
+        return [path for path in paths if path not in ignored]
+
+    def writeTree(self):
+        """Write the index out as a tree.  The index keeps the trees it
+        wrote last time, so only the changed directories are hashed again."""
+        return self._git('write-tree').strip()
+
+    def commitTree(self, tree, parents, msg):
+        args = ['commit-tree', tree, '-m', msg]
+        for parent in parents:
+            args.extend(['-p', parent])
+        return self._git(*args).strip()
+
+    def updateRef(self, name, new, old, msg):
+        """Point name at new if it still points at old (None: doesn't
+        exist yet).  Returns False if it didn't."""
+        return call(['git', 'update-ref', '-m', msg, name, new, old or ''], cwd=self.path) == 0
+
+    def changedPaths(self, old, new):
+        """Repository paths that differ between commits old and new, or
+        None if we can't tell."""
+        if old is None or new is None:
+            return None
+        try:
+            out = self._git('diff-tree', '-r', '--name-only', '-z', old, new)
+        except CalledProcessError:
+            return None
+        return [p for p in out.split('\0') if p != '']
+
+    def changedSince(self, commit):
+        """Repository paths that differ between commit and the work tree,
+        or None if we can't tell."""
+        if commit is None:
+            return None
+        try:
+            out = self._git('diff', '--name-only', '-z', commit)
+        except CalledProcessError:
+            return None
+        return [p for p in out.split('\0') if p != '']
+
+    def stats(self):
+        return {'backend': self.name}
+
+
+class DulwichBackend(CLIBackend):
+    name = 'dulwich'
+
+    def __init__(self, path):
+        super(DulwichBackend, self).__init__(path)
+        self.repo = Repo(path)
+        self.objects_written = 0
+
+    def _add(self, obj):
+        self.repo.object_store.add_object(obj)
+        self.objects_written = self.objects_written + 1
+        return obj.id
+
+    def readRef(self, name):
+        try:
+            return self.repo.refs[name]
+        except KeyError:
+            return None
+
+    def treeOf(self, commit):
+        return self.repo[commit].tree
+
+    def readBlob(self, sha):
+        return self.repo[sha].data
+
+    def writeBlob(self, data):
+        return self._add(Blob.from_string(data))
+
+    def commitTree(self, tree, parents, msg):
+        config = self.repo.get_config_stack()
+        commit = Commit()
+        commit.tree = tree
+        commit.parents = parents
+        commit.author = get_user_identity(config, 'AUTHOR')
+        commit.committer = get_user_identity(config, 'COMMITTER')
+        commit.author_time = commit.commit_time = int(time())
+        offset = -(daylight and localtime().tm_isdst > 0 and altzone or timezone)
+        commit.author_timezone = commit.commit_timezone = offset
+        commit.encoding = 'UTF-8'
+        # git commit-tree -m ends the message with a newline too.
+        commit.message = msg.rstrip('\n') + '\n'
+        return self._add(commit)
+
+    def updateRef(self, name, new, old, msg):
+        if old is None:
+            return self.repo.refs.add_if_new(name, new, message=msg)
+        return self.repo.refs.set_if_equals(name, old, new, message=msg)
+
+    def stats(self):
+        return {'backend': self.name, 'objects_written': self.objects_written}
+
+
+backends = {'cli': CLIBackend, 'dulwich': DulwichBackend}
+
+def openBackend(path, name='cli'):
+    """name is cli, dulwich, or auto for dulwich when it's installed."""
+    if name == 'auto':
+        name = Repo is not None and 'dulwich' or 'cli'
+    if name == 'dulwich' and Repo is None:
+        logging.warning('dulwich is not installed, using the git command line')
+        name = 'cli'
+    return backends[name](path)
@@ -43,75 +43,69 @@ import sys
 import socket
 import platform
 import random
-from errno import EACCES, EBUSY
-from fuse import Operations, FuseOSError, FUSE
+from ctypes import memmove, string_at
+from errno import EACCES, EBUSY, ENOENT
+from stat import S_ISDIR
+from fuse import Operations, FuseOSError
 from sys import argv, exit
 from time import time
-from threading import Lock, Condition, Thread, Timer, Semaphore
+from threading import Lock, Condition, Event, Thread, Timer, Semaphore
 from urlparse import urlparse # used to figure out the host so we can determine if it's remote or local.
 from socket import getaddrinfo, gaierror #call this to translate the host/port into something useable.
 from subprocess import call, check_output
 from SocketServer import ThreadingUnixStreamServer, BaseRequestHandler
 
 from IPy import IP # use to determine if we should consider the ip address local or not.
+from gitfs.DirLister import listEntries
+from gitfs.DirtyTracker import DirtyTracker
+from gitfs.GitBackend import openBackend
+from gitfs.GitFUSE import GitFUSE
+from gitfs.GitStatus import GitStatus
+from gitfs.GroupSync import GroupSync
+from gitfs.HandleTable import HandleTable, O_ACCMODE
 from gitfs.HostInfo import HostInfo
+from gitfs.KernelCache import KernelCache
+from gitfs.LockTable import LockTable
+from gitfs.LRUCache import LRUCache
+from gitfs.MapCache import MapCache
+from gitfs.PosIO import copyRange, pread, preadinto, pwrite, pwritefrom
+from gitfs.ReadAhead import ReadAhead
+from gitfs.WriteBuffer import WriteBuffer
+from gitfs import Trace
 from mUUID import mUUID
 from GitFSClient import GitFSClient
-from GitFSBase import GitFSBase, GitFSError
+from GitFSBase import GitFSBase, GitFSError, escape_cache, unescape_cache, translatePath, unescapeName
 from Packetize import PacketizeMixIn
 
 
-class GitStatus(object):
+def attrDict(st):
+    return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
+        'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
 
-    def __init__(self, path):
-        if not os.getcwd() == path:
-            os.chdir(path)
-        self.status = {}
 
-    def update(self):
-        self.clear()
-        logging.debug('getting status')
-        for line in os.popen('git status').readlines():
-            line = line.strip()
-            if line.startswith('#\t'):
-                try:
-                    status, file = [l.strip() for l in line[2:].split(':')]
-                    if self.status.has_key(file):
-                        self.status[status].append(file)
-                    else:
-                        self.status[status] = [file]
-                except ValueError:
-                    if self.status.has_key('untracked'):
-                        self.status['untracked'].append( line[2:].strip() )
-                    else:
-                        self.status['untracked'] = [ line[2:].strip() ]
-        logging.debug('current status: %r' %self.status)
-        return self.status
-
-    def stagedFiles(self):
-        self.update()
-        return self.status.get('renamed',  []) + \
-               self.status.get('modified', []) + \
-               self.status.get('new file', []) + \
-               self.status.get('deleted',  [])
-
-    def unstagedFiles(self):
-        self.update()
-        return self.status.get('untracked', [])
-
-    def clear(self):
-        self.status.clear()
+def collapsePaths(paths):
+    """Drop the paths that are under another path in paths."""
+    paths = set(paths)
+    collapsed = []
+    for path in paths:
+        parts = path.split('/')
+        if not any('/'.join(parts[:i]) in paths for i in range(1, len(parts))):
+            collapsed.append(path)
+    return collapsed
 
-class GitRepo(GitFSBase, object):
 
-    def __init__(self, path, origin, branch, sync=False):
+class GitRepo(GitFSBase, object):
+    def __init__(self, path, origin, branch, sync=False, changed=None, backend='cli'):
         super(GitRepo, self).__init__()
         self.path = path
-        logging.debug('repo.path = %s' %self.path)
+        logging.debug('repo.path = %s', self.path)
         self.halt = False
         self.origin = origin
         self.branch = branch
+        # called whenever a pull changes the shadow directory.
+        self.changed = changed
         self.status = GitStatus(path)
+        self.backend = openBackend(path, backend)
 
         self.host = None
         self.scheme = None
@@ -128,18 +122,25 @@ class GitRepo(GitFSBase, object):
             self.synchronize()
 
 
-    def synchronize(self):
+    def synchronize(self, paths=None):
+        """Commit whatever changed.  paths are the repository paths that
+        changed, None means ask git to look at the whole tree.  Paths git
+        won't stage are logged and left out, not retried every cycle.
+        Returns False if it has to be tried again."""
         # we need to serialize our access to git.
         if self.push_c.acquire(False):
             try:
-                logging.debug('syncing')
-                if self.syncNeeded():
-                    unstaged = self.status.unstagedFiles()
-                    for file in unstaged:
-                        self.stage(file)
+                logging.debug('syncing %s', paths is None and 'everything' or '%d paths' %len(paths))
+                if paths is not None:
+                    self.stageOrSkip(paths)
+                    self.commitIndex('syncing files @ %s' %datetime.datetime.now())
+                elif self.syncNeeded():
+                    # the snapshot syncNeeded just took.
+                    self.stageOrSkip([p.rstrip('/') for p in self.status.current().untracked])
                     self.commit('syncing files @ %s' %datetime.datetime.now())
-                    # Don't push here since a timer should already be
-                    # going and the push will happen when it should.
+                    self.status.clear()
+                # Don't push here since a timer should already be
+                # going and the push will happen when it should.
             finally:
                 self.push_c.release()
             return True
@@ -167,20 +168,63 @@ class GitRepo(GitFSBase, object):
         return 60*10
 
     def syncNeeded(self):
-        self.status.update()
-        return (self.status.stagedFiles() + self.status.unstagedFiles() and True or
-                (time() - self.last_push > self.syncTime()))
-
-    def stage(self, file):
-        logging.debug('staging file %s' %file)
-        call('git add \"%s\"' %self.escapeQuotes(file), shell=True)
+        # the one status scan of the cycle.
+        return self.status.scan().changed() or (time() - self.last_push > self.syncTime())
+
+    def stagePaths(self, paths):
+        return self.backend.stagePaths(paths)
+
+    def stageOrSkip(self, paths):
+        """Stage paths, leaving out any git won't take so one bad path
+        can't hold up the rest.  When git names the path it stopped at
+        that one is dropped and the rest tried again, otherwise the batch
+        is split in half until the bad ones are found.  Returns the paths
+        left out."""
+        skipped = []
+        while len(paths) > 0 and not self.stagePaths(paths):
+            rejected = self.backend.rejected
+            if rejected not in paths:
+                if len(paths) == 1:
+                    logging.warning('git would not stage %s, leaving it out of the commit', paths[0])
+                    return skipped + paths
+                half = len(paths) / 2
+                return skipped + self.stageOrSkip(paths[:half]) + self.stageOrSkip(paths[half:])
+            logging.warning('git would not stage %s, leaving it out of the commit', rejected)
+            skipped.append(rejected)
+            paths = [p for p in paths if p != rejected]
+        return skipped
+
+    def commitIndex(self, msg):
+        """Commit the index as it is, without refreshing it or looking at
+        the work tree.  Returns the new commit, or None if the index
+        matches HEAD or HEAD moved under us."""
+        backend = self.backend
+        tree = backend.writeTree()
+        parent = backend.head()
+        if parent is not None and backend.treeOf(parent) == tree:
+            return None
+        commit = backend.commitTree(tree, parent is not None and [parent] or [], msg)
+        # HEAD only moves if it is still where we found it.
+        if not backend.updateRef('HEAD', commit, parent, 'commit: ' + msg):
+            logging.warning('HEAD moved while committing %s', commit)
+            return None
+        return commit
 
     def commit(self, msg):
-        call('git commit -am \"%s\"' %self.escapeQuotes(msg), shell=True)
+        """Commit everything git status would show, looking at the whole work tree."""
+        call(['git', 'commit', '-q', '-a', '-m', msg])
 
     def forcePush(self):
         self.last_push = time() - 60*60*24*365
 
+    def head(self):
+        return self.backend.head()
+
+    def changedSince(self, commit):
+        """Return the repository paths that differ between commit and the
+        working tree, or None if we can't tell."""
+        return self.backend.changedSince(commit)
+
     def merge(self):
         logging.debug("merge required.")
         self.merge_needed = 1
@@ -206,7 +250,7 @@ class GitRepo(GitFSBase, object):
                 return 1
 
             pr = urlparse(originurl)
-            logging.debug('originurl = %s, pr = %s' %(originurl, pr))
+            logging.debug('originurl = %s, pr = %s', originurl, pr)
             self.scheme = pr.scheme
             if (pr.scheme != 'file'):
                 host = pr.netloc
@@ -214,15 +258,19 @@ class GitRepo(GitFSBase, object):
                     host = originurl
                     self.host, colon, self.port = host.partition(':')
                     self.port = 80
-                    logging.debug('repo.host = %s' %self.host)
+                    logging.debug('repo.host = %s', self.host)
 
                 if ('@' in self.host):
-                    logging.debug('found @ in %s' %self.host)
+                    logging.debug('found @ in %s', self.host)
                     self.host = self.host.partition('@')[2]
 
             logging.debug('pull')
 
+            old_head = self.head()
             ret = call('git pull --ff-only origin \"%s\"' %self.branch, shell=True)
+            if self.changed is not None and self.head() != old_head:
+                self.changed(self.backend.changedPaths(old_head, self.head()))
+
             if ret != 0:
                 if self.merge_needed != 1:
                     self.merge()
@@ -251,7 +299,7 @@ class GitRepo(GitFSBase, object):
                     self.status.clear() # Clear first
                     ret = call('git push \"%s\" \"%s\"' %(self.origin, self.branch), shell=True)
                 except Exception as e:
-                    logging.debug("push:Exception %s" %e)
+                    logging.debug("push:Exception %s", e)
                     ret = -1
 
                 if ret == 0:
@@ -265,7 +313,7 @@ class GitRepo(GitFSBase, object):
                         self.timer.cancel()
 
                     #we need to check what happened and try again.
-                    self.status.update()
+                    self.status.clear()
                     self.timer = Timer(60, self.push, args=())
                     self.timer.start()
             else:
@@ -273,7 +321,7 @@ class GitRepo(GitFSBase, object):
                     self.timer.cancel()
                 self.timer = Timer(push_time - now + self.last_push, self.push, args=())
                 self.timer.start()
-                logging.debug('try to push again in %d seconds' %(push_time - now + self.last_push))
+                logging.debug('try to push again in %d seconds', push_time - now + self.last_push)
         finally:
             self.push_c.release()
             logging.debug("push done")
@@ -291,27 +339,37 @@ class GitFS(GitFSBase, Operations):
     """A simple filesystem using Git and FUSE.
     """
 
-    def __init__(self, origin, branch='master', path='.', mount_point='.'):
+    # options that can be given in fstab or with -o.  gmount strips
+    # these out before handing the rest to FUSE.
+    option_defaults = { 'attr_cache': 8192, 'negative_cache': 4096, 'dir_cache': 1024, 'readdir_attrs': 4096,
+                        'trace': False,
+                        'durability': 'strict', 'write_buffer': 0, 'mmap_limit': 0,
+                        'mmap_threshold': 1024*1024, 'readahead': 0, 'kernel_timeout': 60,
+                        'writeback_cache': False, 'lowlevel': False, 'threads': 0,
+                        'lock_stripes': 256, 'full_sync': 600, 'git_backend': 'cli' }
+
+    # strict fsyncs on every flush and fsync, batched queues them up for a group
+    # fsync, and relaxed leaves it to the commit.
+    durability_modes = ('strict', 'batched', 'relaxed')
+
+    def __init__(self, origin, branch='master', path='.', mount_point='.', **options):
         super(GitFS, self).__init__()
         self.origin = origin
         self.branch = branch
         self.root = os.path.realpath(path)
         self.mount_point = mount_point
-        self.halt = False
-        self.rwlock = Lock()
-        self.need_sync_time = None
-         # Can't use the default rlock here since we want to acquire/release from different threads
-        self.sync_c = Condition(Lock())
-        self.timer_c = Condition(Lock())
+        self.initOperations(**options)
 
         self.id = None
-        self.timer = None
         self.handlers = { 'ping': self._handlePing, 'lock': self._handleLock, 'unlock': self._handleUnlock,
-                          'info': self._handleInfo, 'getConfig': self._getConfig }
+                          'info': self._handleInfo, 'getConfig': self._getConfig, 'stats': self._handleStats,
+                          'trace': self._handleTrace }
         self.lock_timer = None
         self.lock_lock = Condition()
         self.locks = {}
         self.lock_expire_time = time()
+        # HEAD when a client took the lock, so we can see what it changed.
+        self.lock_head = None
 
         self.control_dir = self.getControlDirectory()
         try:
@@ -358,10 +416,71 @@ class GitFS(GitFSBase, Operations):
         mt[mount_point] = self.getID()
         self.updateMTab(mt)
 
-        self.repo = GitRepo(path, origin, branch, sync=True)
+        # git_backend is cli, dulwich or auto, see GitBackend.
+        self.repo = GitRepo(path, origin, branch, sync=True, changed=self.treeChanged,
+                            backend=self.options['git_backend'])
         self.sync_thread = Thread(target=self._sync, args=())
         self.sync_thread.start()
 
+    def initOperations(self, **options):
+        """Set up what the filesystem operations need, the caches, handles
+        and sync state, without the repository, control socket or mount.
+        gbench drives GitFS on just this."""
+        self.options = dict(self.option_defaults)
+        self.options.update(options)
+        self.halt = False
+        Trace.setEnabled(self.flagOption('trace'))
+        self.attr_cache = LRUCache(int(self.options['attr_cache']))
+        # paths we recently found don't exist.
+        self.negative_cache = LRUCache(int(self.options['negative_cache']))
+        # translated listings, by directory.
+        self.dir_cache = LRUCache(int(self.options['dir_cache']))
+        # how long the kernel may cache names and attributes when we can invalidate them.
+        self.kernel_cache = KernelCache(float(self.options['kernel_timeout']),
+                                        self.flagOption('writeback_cache'), self.flagOption('lowlevel'))
+        # readdir stats directories up to this size and fills in attr_cache.
+        self.readdir_attrs = int(self.options['readdir_attrs'])
+        self.durability = self.options['durability']
+        if self.durability not in self.durability_modes:
+            raise GitFSError('Unknown durability mode %s' %self.durability)
+        self.group_sync = None
+        if self.durability == 'batched':
+            self.group_sync = GroupSync(self.root)
+        # write_buffer is the most bytes we'll hold back across all handles, 0 turns it off.
+        self.handles = HandleTable()
+        self.write_buffer = None
+        if int(self.options['write_buffer']) > 0:
+            self.write_buffer = WriteBuffer(int(self.options['write_buffer']), flushed=self._bufferFlushed)
+        # big files opened read-only are read through mmap, up to mmap_limit bytes mapped.
+        self.map_cache = None
+        if int(self.options['mmap_limit']) > 0:
+            self.map_cache = MapCache(int(self.options['mmap_limit']), int(self.options['mmap_threshold']))
+        # readahead is the largest window we'll prefetch for a sequential reader.
+        self.read_ahead = None
+        if int(self.options['readahead']) > 0:
+            self.read_ahead = ReadAhead(int(self.options['readahead']))
+        # operations that change the same path take turns, everything else runs in parallel.
+        self.path_locks = LockTable(int(self.options['lock_stripes']))
+        # threads caps how many operations run at once, 0 leaves it to libfuse.
+        self.threads = int(self.options['threads'])
+        self.workers = None
+        if self.threads > 1:
+            self.workers = Semaphore(self.threads)
+        # sync requests are just a flag so that flush and friends never wait on the sync thread.
+        self.sync_request = Event()
+         # Can't use the default rlock here since we want to acquire/release from different threads
+        self.sync_lock = Lock()
+        # don't do anything until there is a pause, but don't wait more than 5 minutes either.
+        self.dirty = DirtyTracker(self.forceSync, quiet=10, max_delay=5*60)
+        # syncs only stage the paths we saw change, but every full_sync seconds
+        # git looks at the whole tree in case something got past us.  0 always does.
+        self.full_sync = int(self.options['full_sync'])
+        self.last_full_sync = 0
+
+    def flagOption(self, key):
+        # fstab gives us strings, -o with no value gives us True.
+        return self.options[key] not in (False, 'off', 'no', '0')
+
     def getID(self):
         if self.id is None:
             self.id = mUUID.getUUIDFromFile(self.getUUIDFile(self.root), create=True).toString()
@@ -380,7 +499,8 @@ class GitFS(GitFSBase, Operations):
                 self.lock_timer.cancel()
             else:
                 logging.debug("Aquiring fresh lock")
-                self.sync_c.acquire()
+                self.sync_lock.acquire()
+                self.lock_head = self.repo.head()
             self.lock_timer = Timer(t, self._lockTimerExpire, args=())
             self.lock_timer.start()
         self.lock_lock.release()
@@ -407,7 +527,7 @@ class GitFS(GitFSBase, Operations):
                 self.lock_timer.cancel()
             else:
                 logging.debug("***** ERROR ***** __lockTimerExpire doesn't have lock. acquiring")
-                self.sync_c.acquire()
+                self.sync_lock.acquire()
             self.lock_timer = Timer(t - now, self._lockTimerExpire, args=())
             self.lock_timer.start()
             logging.debug("extending lock.")
@@ -416,7 +536,9 @@ class GitFS(GitFSBase, Operations):
                 logging.debug("releasing lock.")
                 self.lock_timer.cancel()
                 self.lock_timer = None
-                self.sync_c.release()
+                self.sync_lock.release()
+                # whoever held the lock may have changed the shadow directory behind our back.
+                self.treeChanged(self.repo.changedSince(self.lock_head))
 
 
     def _unlock(self, name):
@@ -436,7 +558,7 @@ class GitFS(GitFSBase, Operations):
             mf = self.handlers[d['action']]
             return mf(d, request)
 
-        logging.debug("No request in packet: %s" %d)
+        logging.debug("No request in packet: %s", d)
         self._respond(request, {'status': 'Unknown Command'})
         return None
 
@@ -457,37 +579,92 @@ class GitFS(GitFSBase, Operations):
     def _handleInfo(self, reqDict, request):
         self._respond(request,{'status': 'ok', 'origin': self.repo.origin,
                                'branch': self.repo.branch, 'root':self.root,
-                               'path':self.mount_point })
+                               'path':self.mount_point, 'durability': self.durability })
 
     def _getConfig(self, reqDict, request):
         key = reqDict['key']
         resp = self.getConfigForInstance(key)
         self._respond(request, {'status': 'ok', key:resp })
 
+    def _handleStats(self, reqDict, request):
+        resp = {'status': 'ok'}
+        sources = [('attr_cache', self.attr_cache), ('negative_cache', self.negative_cache),
+                   ('dir_cache', self.dir_cache), ('escape_cache', escape_cache),
+                   ('unescape_cache', unescape_cache), ('kernel', self.kernel_cache),
+                   ('path_locks', self.path_locks), ('handles', self.handles),
+                   ('status', self.repo.status), ('git', self.repo.backend)]
+        if self.write_buffer is not None:
+            sources.append(('write_buffer', self.write_buffer))
+        if self.map_cache is not None:
+            sources.append(('mmap', self.map_cache))
+        if self.read_ahead is not None:
+            sources.append(('readahead', self.read_ahead))
+        for (name, cache) in sources:
+            for (key, value) in cache.stats().iteritems():
+                resp['%s_%s' %(name, key)] = '%s' %value
+        self._respond(request, resp)
+
+    def _handleTrace(self, reqDict, request):
+        if 'enable' in reqDict:
+            Trace.setEnabled(reqDict['enable'] in ('on', 'yes', '1', 'true'))
+        self._respond(request, {'status': 'ok', 'trace': Trace.enabled and 'on' or 'off'})
+
     def _sync(self):
         while True:
-            self.sync_c.acquire()
-            if not self.halt:
-                # wait till a sync request comes
-                self.sync_c.wait()
-                self.timer_c.acquire()
-                if self.timer != None:
-                    self.timer.cancel()
-                    self.timer = None
-                self.timer_c.release()
+            # wait till a sync request comes.  Clear it before syncing so
+            # requests that come in while we are busy get another pass.
+            self.sync_request.wait()
+            self.sync_request.clear()
+            # sync_lock is also held by control socket clients that need git left alone.
+            with self.sync_lock:
+                if self.halt:
+                    self.repo.forcePush()
+                    self.repo.push()
+                    break
                 try:
-                    if not self.repo.synchronize():
-                        #sync failed, we need to try again.
-                        self.needSync()
-                    self.need_sync_time = None
+                    # take the paths first, a write marked after this is
+                    # left for the next sync even if the flush below
+                    # already wrote it out.
+                    paths = self.dirty.take()
+                    # the commit has to see anything still held in memory.
+                    if self.write_buffer is not None:
+                        self.write_buffer.flushAll()
+                    if self.group_sync is not None:
+                        self.group_sync.flush()
+                    full = time() - self.last_full_sync >= self.full_sync
+                    targeted = None
+                    if not full:
+                        targeted = self.repoPaths(paths)
+                        if targeted is not None and len(targeted) == 0:
+                            # every flush asks for a sync, don't run git when nothing changed.
+                            continue
+                    synced = False
+                    try:
+                        synced = self.repo.synchronize(targeted)
+                    finally:
+                        if not synced:
+                            #sync failed, we need to try again.
+                            self.dirty.restore(paths)
+                            self.needSync()
+                    if synced and targeted is None:
+                        self.last_full_sync = time()
                 except Exception as e:
-                    logging.debug("synchronize threw exception %s" %e)
-                self.sync_c.release() # can't release this until sync is complete because we can't change files while we sync.
-            else:
-                self.repo.forcePush()
-                self.repo.push()
-                self.sync_c.release()
-                break
+                    logging.debug("synchronize threw exception %s", e)
+
+    def repoPaths(self, paths):
+        """Turn shadow paths from the dirty tracker into repository paths.
+        Returns None if the whole tree has to be looked at."""
+        prefix = self.root + '/'
+        relative = []
+        for path in paths:
+            if not path.startswith(prefix):
+                continue
+            path = path[len(prefix):].rstrip('/')
+            if path == '':
+                # the root itself changed.
+                return None
+            relative.append(path)
+        return collapsePaths(relative)
 
     def getHostInfo(self):
         if self.hostinfo is None:
@@ -510,7 +687,7 @@ class GitFS(GitFSBase, Operations):
         return hostinfo.matchHostName(key)
 
     def getConfigForInstanceSingleFile(self, key, name):
-        logging.debug('getConfigForInstanceSingleFile(%s, %s)' %(key, name))
+        logging.debug('getConfigForInstanceSingleFile(%s, %s)', key, name)
         c = self.getConfig(name)
         if c is None:
             return None
@@ -518,7 +695,7 @@ class GitFS(GitFSBase, Operations):
         if key not in c:
             return None
         v = c[key]
-        logging.debug('getConfigForInstanceSingleFile(%s, %s) value=%s' %(key, name, v))
+        logging.debug('getConfigForInstanceSingleFile(%s, %s) value=%s', key, name, v)
         if isinstance(v, dict):
             rv = None
             for (key, value) in v.iteritems():
@@ -539,7 +716,7 @@ class GitFS(GitFSBase, Operations):
     def getConfigForInstance(self, key):
         match=0
         value=None
-        logging.debug('getConfigForInstance(%s)' %key)
+        logging.debug('getConfigForInstance(%s)', key)
         if key in self.config_file_priorities:
             filenames = self.config_file_priorities[key]
         else:
@@ -557,34 +734,108 @@ class GitFS(GitFSBase, Operations):
 
     def forceSync(self):
         logging.debug('forceSync()')
-        self.sync_c.acquire()
-        self.sync_c.notifyAll()
-        self.sync_c.release()
-
-    def needSync(self):
-        logging.debug('needSync()')
-        self.timer_c.acquire()
-        if self.need_sync_time is None:
-            self.need_sync_time = time()
-
-        if self.timer != None:
-            if time() - self.need_sync_time > 5*60:
-                return
-            self.timer.cancel()
-
-        # don't do anything until there is a pause.
-        self.timer = Timer(10, self.forceSync, args=())
-        self.timer.start()
-        self.timer_c.release()
+        self.sync_request.set()
+
+    def needSync(self, path=None):
+        if Trace.enabled:
+            logging.debug('needSync(%s)', path)
+        self.dirty.mark(path)
+
+    def mountOptions(self):
+        options = self.kernel_cache.mountOptions()
+        if self.threads == 1:
+            options['nothreads'] = True
+        return options
+
+    def treeChanged(self, paths=None):
+        """The shadow directory was changed by something other than us,
+        usually a pull.  paths are the changed repository paths.  Without
+        them, forget everything we've cached."""
+        if paths is not None:
+            return self._pathsChanged(paths)
+
+        # the kernel's caches can't be flushed wholesale, they run out with the timeouts.
+        logging.debug('treeChanged()')
+        self.attr_cache.clear()
+        self.negative_cache.clear()
+        self.dir_cache.clear()
+        if self.map_cache is not None:
+            self.map_cache.clear()
+        if self.read_ahead is not None:
+            self.read_ahead.invalidateAll()
+
+    def _pathsChanged(self, paths):
+        logging.debug('treeChanged(%d paths)', len(paths))
+        directories = set()
+        kernel_paths = set()
+        for path in paths:
+            shadow = self.root + '/' + path
+            self._invalidateEntry(shadow, tree=True)
+            self._contentChanged(shadow)
+            kernel_paths.add(translatePath('/' + path, unescapeName))
+            # new or removed directories change every listing up to the top.
+            path = os.path.dirname(path)
+            while path != '' and path not in directories:
+                directories.add(path)
+                path = os.path.dirname(path)
+
+        for path in directories:
+            self._invalidateEntry(self.root + '/' + path)
+            kernel_paths.add(translatePath('/' + path, unescapeName))
+        kernel_paths.add('/')
+        self.kernel_cache.invalidate(kernel_paths)
+
+    def _invalidate(self, path):
+        self.attr_cache.discard(path)
+
+    def _contentChanged(self, path):
+        # mappings and read ahead data can't follow the file once it changes.
+        if self.map_cache is not None:
+            self.map_cache.drop(path)
+        if self.read_ahead is not None:
+            self.read_ahead.invalidate(path)
+
+    def _bufferFlushed(self, path):
+        # a mapping made before the data got to the file is too short.
+        if self.map_cache is not None:
+            self.map_cache.drop(path)
+
+    def _invalidateEntry(self, path, tree=False):
+        """path was added or removed, so its parent changed as well.  Use
+        tree when everything below path moved too."""
+        if tree:
+            self.attr_cache.discardTree(path)
+            self.negative_cache.discardTree(path)
+            self.dir_cache.discardTree(path)
+        else:
+            self.attr_cache.discard(path)
+            self.negative_cache.discard(path)
+            self.dir_cache.discard(path)
+        parent = os.path.dirname(path)
+        if parent == self.root:
+            # that's how the top directory comes in from FUSE.
+            parent = self.root + '/'
+        self.attr_cache.discard(parent)
+        self.dir_cache.discard(parent)
 
     def shutdown(self):
+        self.dirty.stop()
+        if self.write_buffer is not None:
+            self.write_buffer.flushAll()
+        if self.map_cache is not None:
+            self.map_cache.stop()
+        if self.read_ahead is not None:
+            self.read_ahead.stop()
+        if self.group_sync is not None:
+            self.group_sync.stop()
         # stop sync thread
-        self.sync_c.acquire()
         self.halt = True
-        self.sync_c.notifyAll()
-        self.sync_c.release()
+        self.sync_request.set()
         self.repo.shutDown()
 
+    def init(self, path):
+        self.kernel_cache.attach()
+
     def destroy(self, path):
         self.shutdown()
         if self.control_server != None:
@@ -595,95 +846,318 @@ class GitFS(GitFSBase, Operations):
                 pass
 
     def __call__(self, op, path, *args):
+        if self.workers is not None:
+            with self.workers:
+                return self._dispatch(op, path, *args)
+        return self._dispatch(op, path, *args)
+
+    def _dispatch(self, op, path, *args):
         try:
-            logging.debug("calling %s on %s" %(op, path))
+            if Trace.enabled:
+                logging.debug("calling %s on %s", op, path)
             path = self.escapePath(path)
             r = super(GitFS, self).__call__(op, self.root + path, *args)
-            pr = "%s" %r
-            pr = pr[:10]
-            logging.debug("returning %s for %s" %(pr, op))
+            if Trace.enabled:
+                logging.debug("returning %s for %s", Trace.preview(r), op)
             return r
         except Exception as e:
-            logging.debug("Unhandled exception %s" %e)
+            # errors from the shadow directory are routine (build tools probe for lots
+            # of files that aren't there), so only log those when tracing.
+            if not isinstance(e, OSError) or (Trace.enabled and e.errno != ENOENT):
+                logging.debug("Unhandled exception %s", e)
             raise e
 
+    def _missing(self, path, generation):
+        self.negative_cache.put(path, True, generation)
+        raise FuseOSError(ENOENT)
+
     def access(self, path, mode):
+        if self.negative_cache.get(path) is not None:
+            raise FuseOSError(ENOENT)
+
+        generation = self.negative_cache.generation
         if not os.access(path, mode):
+            if not os.path.lexists(path):
+                self._missing(path, generation)
             raise FuseOSError(EACCES)
 
     def chmod(self, path, mode):
-        self.needSync()
-        return os.chmod(path, mode)
+        with self.path_locks.hold(path):
+            os.chmod(path, mode)
+            self.needSync(path)
+            self._invalidate(path)
 
     def chown(self, path, uid, gid):
-        self.needSync()
-        return super(GitFS, self).chown(path, uid, gid)
+        with self.path_locks.hold(path):
+            r = super(GitFS, self).chown(path, uid, gid)
+            self.needSync(path)
+            self._invalidate(path)
+            return r
 
-    def create(self, path, mode):
-        # XXXXX Fixme what should the flags be?
-        return os.open(path, os.O_RDWR | os.O_CREAT, mode)
+    # GitFUSE passes create the open flags.
+    create_flags = True
+
+    def copy_file_range(self, path_in, fh_in, offset_in, path_out, fh_out, offset_out, size, flags):
+        """cp within the mount.  The copy happens between the shadow files
+        without the data coming up to python."""
+        path_out = self.root + self.escapePath(path_out)
+        if self.write_buffer is not None:
+            self.write_buffer.flushRange(path_in, offset_in, size)
+            self.write_buffer.flushPath(path_out)
+        r = copyRange(fh_in, offset_in, fh_out, offset_out, size)
+        self._written(path_out, fh_out)
+        return r
+
+    def create(self, path, mode, flags=None):
+        if flags is None:
+            flags = os.O_RDWR
+        flags = flags | os.O_CREAT
+        with self.path_locks.hold(path):
+            if self.kernel_cache.writeback:
+                f = self._openForWriteback(path, flags, mode)
+            else:
+                f = os.open(path, flags, mode)
+            self.handles.add(f, flags)
+            self.needSync(path)
+            self._invalidateEntry(path)
+            if flags & os.O_TRUNC:
+                # it may have been there already.
+                self._contentChanged(path)
+            return f
 
     def flush(self, path, fh):
-        self.sync_c.acquire()
-        self.sync_c.notifyAll()
-        self.sync_c.release()
-        return os.fsync(fh)
+        # only raises a flag, a sync or an external lock in progress can't hold up a close.
+        self.sync_request.set()
+        return self._makeDurable(fh)
 
     def fsync(self, path, datasync, fh):
-        self.needSync()
-        return os.fsync(fh)
+        self.needSync(path)
+        # unlike flush, fsync covers the whole file, whichever handle wrote
+        # it, so it is never skipped.
+        if self.write_buffer is not None:
+            self.write_buffer.flushPath(path)
+        self.handles.synced(fh)
+        return self._durable(fh)
+
+    def _makeDurable(self, fh):
+        if self.write_buffer is not None:
+            self.write_buffer.flushHandle(fh)
+        if not self.handles.needsSync(fh):
+            return
+        return self._durable(fh)
+
+    def _durable(self, fh):
+        if self.durability == 'strict':
+            os.fsync(fh)
+        elif self.durability == 'batched':
+            self.group_sync.add(fh)
 
     def fsyncdir(self, path, datasync, fh):
         return self.fsync(path, datasync, fh)
 
     def getattr(self, path, fh=None):
-        st = os.lstat(path)
-        return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-            'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+        attrs = self.attr_cache.get(path)
+        if attrs is not None:
+            return attrs
+
+        if fh is not None:
+            return self._fgetattr(path, fh)
+
+        if self.negative_cache.get(path) is not None:
+            raise FuseOSError(ENOENT)
+
+        if self.write_buffer is not None:
+            # the size has to include anything we're still holding.
+            self.write_buffer.flushPath(path)
+        generation = self.attr_cache.generation
+        negative_generation = self.negative_cache.generation
+        try:
+            st = os.lstat(path)
+        except OSError as e:
+            if e.errno == ENOENT:
+                self._missing(path, negative_generation)
+            raise
+        return self._cacheAttrs(path, st, generation)
+
+    def _cacheAttrs(self, path, st, generation):
+        """attrDict(st), kept in attr_cache unless the file has other
+        names.  A write through another name wouldn't invalidate it."""
+        attrs = attrDict(st)
+        if st.st_nlink <= 1 or S_ISDIR(st.st_mode):
+            self.attr_cache.put(path, attrs, generation)
+        return attrs
+
+    def _fgetattr(self, path, fh):
+        """fstat on an open file, no path lookup and works after an unlink.
+        Not cached, the handle may no longer be what path names."""
+        if self.write_buffer is not None:
+            self.write_buffer.flushHandle(fh)
+        return attrDict(os.fstat(fh))
 
     getxattr = None
 
     def link(self, target, source):
-        source = self.escapePath(source)
-        self.needSync()
-        return os.link(source, target)
+        self._link(target, self.root + self.escapePath(source))
+
+    def _link(self, target, source):
+        """link with both paths already in the shadow directory."""
+        with self.path_locks.hold(target, source):
+            os.link(source, target)
+            self.needSync(target)
+            # the link count of the source changes too.
+            self._invalidate(source)
+            self._invalidateEntry(target)
 
     listxattr = None
-    mknod = os.mknod
+
+    def mknod(self, path, mode, dev):
+        with self.path_locks.hold(path):
+            os.mknod(path, mode, dev)
+            self.needSync(path)
+            self._invalidateEntry(path)
 
     def mkdir(self, path, mode):
-        return os.mkdir(path, mode)
+        with self.path_locks.hold(path):
+            os.mkdir(path, mode)
+            self.needSync(path)
+            self._invalidateEntry(path)
 
     def open(self, path, fip):
-        f = os.open(path, fip)
-        logging.debug("open(%s, %s): %d" %(path, fip, f))
+        if self.kernel_cache.writeback:
+            f = self._openForWriteback(path, fip)
+        else:
+            f = os.open(path, fip)
+        self.handles.add(f, fip)
+        if fip & os.O_TRUNC:
+            # the truncate is a change even if nothing is written after it.
+            self.needSync(path)
+            self._invalidate(path)
+            self._contentChanged(path)
+        elif self.map_cache is not None and fip & O_ACCMODE == os.O_RDONLY:
+            if self.write_buffer is not None:
+                # the mapping has to include what's still held back.
+                self.write_buffer.flushPath(path)
+            try:
+                self.map_cache.opened(path, f)
+            except EnvironmentError as e:
+                # reads just go through pread instead.
+                if Trace.enabled:
+                    logging.debug('not mapping %s: %s', path, e)
+        if Trace.enabled:
+            logging.debug("open(%s, %s): %d", path, fip, f)
         return f
 
+    def _openForWriteback(self, path, fip, mode=0777):
+        # the kernel reads to fill in partial pages even on write only handles,
+        # and does appends itself, sending the writes with real offsets.
+        flags = fip & ~os.O_APPEND
+        if flags & O_ACCMODE == os.O_WRONLY:
+            try:
+                return os.open(path, (flags & ~O_ACCMODE) | os.O_RDWR, mode)
+            except OSError as e:
+                if e.errno != EACCES:
+                    raise
+                # a write only file, the kernel will have to live without reads.
+        return os.open(path, flags, mode)
+
     def read(self, path, size, offset, fh):
-        with self.rwlock:
-            os.lseek(fh, offset, 0)
-            return os.read(fh, size)
+        if self.write_buffer is not None:
+            self.write_buffer.flushRange(path, offset, size)
+        if self.map_cache is not None:
+            data = self.map_cache.read(path, size, offset)
+            if data is not None:
+                return data
+        if self.read_ahead is not None and (self.write_buffer is None or path not in self.write_buffer.paths):
+            # prefetches go straight to the shadow file, so not while writes are held back.
+            return self.read_ahead.read(fh, path, size, offset)
+        # positional reads don't move the file offset, so no lock is needed.
+        return pread(fh, size, offset)
+
+    def readinto(self, path, buf, size, offset, fh):
+        """read straight into FUSE's buffer."""
+        if self.map_cache is None and self.read_ahead is None:
+            if self.write_buffer is not None:
+                self.write_buffer.flushRange(path, offset, size)
+            return preadinto(fh, buf, size, offset)
+        # mappings and read ahead hand back data that's already in memory.
+        data = self.read(path, size, offset, fh)
+        memmove(buf, data, len(data))
+        return len(data)
 
     def readdir(self, path, fh):
-        files = os.listdir(path)
-        uefiles = []
-        for file in files:
-            if self.isValidPath(file):
-                uefiles = uefiles + [self.unescapePath(file)]
-        return [ '.', '..'] + uefiles
+        listing = self.dir_cache.get(path)
+        if listing is not None:
+            return listing
+
+        generation = self.dir_cache.generation
+        attr_generation = self.attr_cache.generation
+        entries = listEntries(path)
+        listing = ['.', '..']
+        if len(entries) > self.readdir_attrs:
+            # statting it all would just push everything else out of attr_cache.
+            listing.extend([name for (name, shadow) in entries])
+        else:
+            # the kernel is about to ask for all of these, so do it while we're here
+            # and hand them back with the names.  Only the file type of the inline
+            # attributes is used, so it doesn't matter that the cached copy ages.
+            prefix = path.rstrip('/') + '/'
+            buffered = ()
+            if self.write_buffer is not None:
+                buffered = self.write_buffer.paths
+            for (name, shadow) in entries:
+                try:
+                    st = os.lstat(prefix + shadow)
+                except OSError:
+                    # gone already.
+                    continue
+                if prefix + shadow in buffered:
+                    # the size on disk is short of what we're holding back.
+                    attrs = attrDict(st)
+                else:
+                    attrs = self._cacheAttrs(prefix + shadow, st, attr_generation)
+                listing.append((name, attrs, 0))
+        self.dir_cache.put(path, listing, generation)
+        return listing
 
     readlink = os.readlink
 
     def release(self, path, fh):
+        self.handles.remove(fh)
+        if self.write_buffer is not None:
+            self.write_buffer.release(fh)
+        if self.read_ahead is not None:
+            self.read_ahead.release(fh)
         return os.close(fh)
 
     def rename(self, old, new):
-        self.needSync()
-        return os.rename(old, self.root + self.escapePath(new))
+        self._rename(old, self.root + self.escapePath(new))
+
+    def _rename(self, old, new):
+        """rename with both paths already in the shadow directory."""
+        with self.path_locks.hold(old, new):
+            if self.map_cache is not None:
+                self.map_cache.dropTree(old)
+                self.map_cache.dropTree(new)
+            try:
+                tree = S_ISDIR(os.lstat(old).st_mode)
+            except OSError:
+                # the rename will say why.
+                tree = False
+            os.rename(old, new)
+            self.needSync(old)
+            self.needSync(new)
+            if self.write_buffer is not None:
+                # later writes through open handles go to the new name.
+                self.write_buffer.rename(old, new)
+            # scanning the caches for children is only worth it for a directory.
+            self._invalidateEntry(old, tree)
+            self._invalidateEntry(new, tree)
 
     def rmdir(self, path):
-        self.needSync()
-        return os.rmdir(path)
+        with self.path_locks.hold(path):
+            os.rmdir(path)
+            self.needSync(path)
+            self._invalidateEntry(path)
 
     def statfs(self, path):
         stv = os.statvfs(path)
@@ -692,35 +1166,78 @@ class GitFS(GitFSBase, Operations):
             'f_frsize', 'f_namemax'))
 
     def symlink(self, target, source):
-        self.needSync()
-        return os.symlink(source, target)
+        with self.path_locks.hold(target):
+            os.symlink(source, target)
+            self.needSync(target)
+            self._invalidateEntry(target)
 
     def truncate(self, path, length, fh=None):
-        self.needSync()
-        with open(path, 'r+') as f:
-            f.truncate(length)
+        handle = None
+        if fh is not None:
+            handle = self.handles.get(fh)
+        with self.path_locks.hold(path):
+            if self.write_buffer is not None:
+                self.write_buffer.flushPath(path)
+            self._contentChanged(path)
+            if handle is not None and handle.writable():
+                os.ftruncate(fh, length)
+                handle.written = True
+            else:
+                with open(path, 'r+') as f:
+                    f.truncate(length)
+            self.needSync(path)
+            self._invalidate(path)
 
     def unlink(self, path):
-        self.needSync()
-        return os.unlink(path)
-
-    utimens = os.utime
+        with self.path_locks.hold(path):
+            if self.write_buffer is not None:
+                self.write_buffer.flushPath(path)
+            self._contentChanged(path)
+            os.unlink(path)
+            self.needSync(path)
+            self._invalidateEntry(path)
+
+    def utimens(self, path, times=None):
+        with self.path_locks.hold(path):
+            os.utime(path, times)
+            self.needSync(path)
+            self._invalidate(path)
 
     def write(self, path, data, offset, fh):
-        self.needSync()
-        with self.rwlock:
-            os.lseek(fh, offset, 0)
-            return os.write(fh, data)
+        if self.write_buffer is not None:
+            r = self.write_buffer.write(fh, path, data, offset)
+        else:
+            r = pwrite(fh, data, offset)
+        self._written(path, fh)
+        return r
+
+    def writefrom(self, path, buf, size, offset, fh):
+        """write straight out of FUSE's buffer."""
+        if self.write_buffer is not None:
+            # the buffer outlives this call, so it needs its own copy anyway.
+            return self.write(path, string_at(buf, size), offset, fh)
+        r = pwritefrom(fh, buf, size, offset)
+        self._written(path, fh)
+        return r
+
+    def _written(self, path, fh):
+        # marked after the change, so a sync that takes the dirty paths
+        # before it happened can't drop it.
+        self.needSync(path)
+        self.handles.written(fh)
+        self._invalidate(path)
+        # after the write, so a prefetch that raced with it gets thrown away.
+        self._contentChanged(path)
 
 def main(origin, branch, local, mountpt):
     gitfs = GitFS(origin, branch, local, mountpt)
-    options = {}
+    options = gitfs.mountOptions()
     options['foreground']=True
     if platform.system == 'Darwin':
         dir, fil = os.path.split(mountpt)
         options['volname'] = fil
 
-    fuse = FUSE(gitfs, mountpt, **options)
+    fuse = GitFUSE(gitfs, mountpt, **options)
     gitfs.destroy(None)
 
 if __name__ == "__main__":
@@ -27,10 +27,40 @@ import socket
 import errno
 
 from LockFile import LockFile
+from LRUCache import LRUCache
 from Packetize import PacketizeMixIn
 from gitfs import ConfigFile
 
 
+def escapeName(name):
+    if name != '.' and name != '..' and len(name) > 0 and name[0] in '@._':
+        return '@' + name
+    return name
+
+def unescapeName(name):
+    if name != '.' and name != '..' and len(name) > 0 and name[0] == '@':
+        return name[1:]
+    return name
+
+def validName(name):
+    if name != '.' and name != '..' and len(name) > 0:
+        if name[0] == '.':
+            return False
+        if name[0] == '@' and (len(name) < 2 or not name[1] in '@._'):
+            return False
+    return True
+
+def translatePath(path, translate):
+    """Apply translate to every name in path in a single pass."""
+    return '/'.join([translate(name) for name in path.split('/')])
+
+# Translations only depend on the path, so everyone shares these.
+# Escaping also fills in the reverse mapping.  The other way around isn't
+# safe since not every shadow name is the escaped form of something
+# (_foo unescapes to itself but escapes to @_foo).
+escape_cache = LRUCache(16384)
+unescape_cache = LRUCache(16384)
+
 class GitFSStringMixIn:
     """A collection of functions that manipulate strings and all the
     different components have to do in the same way.
@@ -45,39 +75,30 @@ class GitFSStringMixIn:
         return string
 
     def escapePath(self, path):
-        #logging.debug('escapePath(%s)' %path)
-        if path == '/' or path == '':
-            return path
-        dir, fil = os.path.split(path)
-
-        if fil != '.' and fil != '..' and len(fil) > 0 and fil[0] in '@._':
-            fil = '@' + fil
-        return os.path.join(self.escapePath(dir), fil)
+        if path.count('/') < 2:
+            # a single name, cheaper to translate it than to look it up.
+            return translatePath(path, escapeName)
+        epath = escape_cache.get(path)
+        if epath is None:
+            epath = translatePath(path, escapeName)
+            escape_cache.put(path, epath)
+            unescape_cache.put(epath, path)
+        return epath
 
     def unescapePath(self, path):
-        logging.debug('unescapePath(%s)' %path)
-        if path == '/' or path == '':
-            return path
-        dir, fil = os.path.split(path)
-
-        if fil != '.' and fil != '..' and len(fil) > 0 and fil[0] == '@':
-            fil = fil[1:]
-
-        return os.path.join(self.unescapePath(dir), fil)
+        if path.count('/') < 2:
+            return translatePath(path, unescapeName)
+        upath = unescape_cache.get(path)
+        if upath is None:
+            upath = translatePath(path, unescapeName)
+            unescape_cache.put(path, upath)
+        return upath
 
     def isValidPath(self, path):
-        if path == '/' or path == '':
-            return True
-
-        dir, fil = os.path.split(path)
-
-        if fil != '.' and fil != '..' and len(fil) > 0:
-            if fil[0] == '.':
-                return False
-            if fil[0] == '@' and (len(fil) < 2 or not fil[1] in '@._') :
+        for name in path.split('/'):
+            if not validName(name):
                 return False
-
-        return self.isValidPath(dir)
+        return True
 
     def parseDict(self, data):
         dict = {}
@@ -166,7 +187,7 @@ class GitFSBase(PacketizeMixIn, GitFSStringMixIn, object):
 
     def getConfigFileName(self, name):
         if name not in self.config_files:
-            logging.debug('config_files %s=%s' %(name, self.config_files[name]))
+            logging.debug('config_files %s=%s', name, self.config_files[name])
             return None
         path = self.config_files[name]
         os.environ['GITFSDIR'] = self.getGitFSDir()
@@ -193,7 +214,7 @@ class GitFSBase(PacketizeMixIn, GitFSStringMixIn, object):
         finally:
             if lock:
                 self.unlockGitFSDir()
-        logging.debug('read configuration: %s\n' %cf.getConfig())
+        logging.debug('read configuration: %s\n', cf.getConfig())
         return cf.getConfig()
 
     def updateMTab(self, mtab):
@@ -211,7 +232,7 @@ class GitFSBase(PacketizeMixIn, GitFSStringMixIn, object):
         cf = ConfigFile()
         files = []
         f = self.getConfigFileName(name)
-        logging.debug('getConfig filename for %s is %s' %(name, f))
+        logging.debug('getConfig filename for %s is %s', name, f)
         if f is None:
             return None
         files.append(f)
@@ -237,13 +258,13 @@ class GitFSBase(PacketizeMixIn, GitFSStringMixIn, object):
 
     def _sendDict(self, dict):
         if self.socket == None:
-            logging.debug('need to create new socket to connect to %s' %self.socket_path)
+            logging.debug('need to create new socket to connect to %s', self.socket_path)
             if not os.path.exists(self.socket_path):
-                logging.debug('socket %s doesn\'t exist' %self.socket_path)
+                logging.debug('socket %s doesn\'t exist', self.socket_path)
                 raise socket.error("Socket Not Found")
             logging.debug('about to create unix socket')
             self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            logging.debug('new socket = %s' %self.socket)
+            logging.debug('new socket = %s', self.socket)
             logging.debug('about to connect.')
             self.socket.connect(self.socket_path)
             logging.debug('setting timeout.')
@@ -257,7 +278,7 @@ class GitFSBase(PacketizeMixIn, GitFSStringMixIn, object):
             return None
         dict = self.packet[0]
         self.packet=[]
-        logging.debug('_recvDict returning %s' %dict)
+        logging.debug('_recvDict returning %s', dict)
         return dict
 
     def handleDict(self, dict):
@@ -274,7 +295,7 @@ class GitFSBase(PacketizeMixIn, GitFSStringMixIn, object):
                 self.socket = None
                 return None
             except socket.error as so:
-                logging.debug("socket error so=%s" %so)
+                logging.debug("socket error so=%s", so)
                 self.socket = None
                 if so.errno != errno.EPIPE:
                     raise so
@@ -36,8 +36,7 @@ from glob import iglob
 from threading import Thread
 from subprocess import call
 
-from gitfs.GitFSBase import GitFSError
-from gitfs import GitFSBase
+from gitfs.GitFSBase import GitFSBase, GitFSError
 
 
 class GitFSClient(GitFSBase, object):
@@ -209,6 +208,25 @@ class GitFSClient(GitFSBase, object):
         except KeyError:
             return False
 
+    def getStatsRemote(self):
+        """Returns the cache counters kept by the filesystem."""
+        res = self.executeRemote({'action': 'stats'})
+        if res is None or res.get('status') != 'ok':
+            return {}
+        del res['status']
+        return res
+
+    def traceRemote(self, enable=None):
+        """Turns tracing of filesystem operations on or off.  Returns
+        whether it is on afterwards."""
+        req = {'action': 'trace'}
+        if enable is not None:
+            req['enable'] = enable and 'on' or 'off'
+        res = self.executeRemote(req)
+        if res is None:
+            return False
+        return res.get('trace') == 'on'
+
     def close(self):
         return
 
@@ -0,0 +1,75 @@
+#!/usr/bin/env python2
+# GitFUSE.py  -*- python -*-
+# Copyright (c) 2013 Ross Biro
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+"""GitFUSE is fusepy's FUSE with a buffer based read and write protocol.
+
+fusepy has an operation's read return a string, which it then copies
+into the buffer libfuse gave it, and turns every write buffer into a
+string before calling write.  When the operations have readinto or
+writefrom, GitFUSE hands them libfuse's buffer instead:
+
+    readinto(path, buf, size, offset, fh) -> bytes read into buf
+    writefrom(path, buf, size, offset, fh) -> bytes written from buf
+
+Operations without them get the usual read and write.
+
+fusepy also drops the open flags on the way to create.  Operations with
+create_flags set get them as a third argument:
+
+    create(path, mode, flags) -> fh
+
+copy_file_range is passed on to the operations whenever the fusepy and
+libfuse underneath have it (libfuse 3.4 and later).
+"""
+
+from fuse import FUSE
+
+
+class GitFUSE(FUSE):
+    def _path(self, path):
+        # newer fusepy decodes paths for the operations, older ones pass them through.
+        decode = getattr(self, '_decode_optional_path', None)
+        if decode is not None:
+            return decode(path)
+        return path
+
+    def _fh(self, fip):
+        if self.raw_fi:
+            return fip.contents
+        return fip.contents.fh
+
+    def create(self, path, mode, fip):
+        if self.raw_fi or not getattr(self.operations, 'create_flags', False):
+            return super(GitFUSE, self).create(path, mode, fip)
+        fi = fip.contents
+        fi.fh = self.operations('create', self._path(path), mode, fi.flags)
+        return 0
+
+    def copy_file_range(self, path_in, fip_in, offset_in, path_out, fip_out, offset_out, size, flags):
+        return self.operations('copy_file_range', self._path(path_in), self._fh(fip_in), offset_in,
+                               self._path(path_out), self._fh(fip_out), offset_out, size, flags)
+
+    def read(self, path, buf, size, offset, fip):
+        if not hasattr(self.operations, 'readinto'):
+            return super(GitFUSE, self).read(path, buf, size, offset, fip)
+        return self.operations('readinto', self._path(path), buf, size, offset, self._fh(fip))
+
+    def write(self, path, buf, size, offset, fip):
+        if not hasattr(self.operations, 'writefrom'):
+            return super(GitFUSE, self).write(path, buf, size, offset, fip)
+        return self.operations('writefrom', self._path(path), buf, size, offset, self._fh(fip))
@@ -0,0 +1,154 @@
+#!/usr/bin/env python2
+# GitStatus.py  -*- python -*-
+# Copyright (c) 2013 Ross Biro
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+"""GitStatus tells the sync thread what git status has to say about the
+shadow directory.
+
+It reads `git status --porcelain=v2 -z`, which is meant for programs: one
+NUL terminated record per changed path, no quoting, and a format that
+doesn't change with the user's language or git version.  The output is
+parsed a chunk at a time as git writes it, so nothing ever holds the
+whole of it.
+
+A scan produces a StatusSnapshot.  It only counts the changes to tracked
+files, which commit -a picks up without being told about them, and
+keeps the paths of untracked files, which have to be staged by name.
+Clean files never show up in the output, so how much a scan holds
+depends on what changed, not on the size of the repository.
+
+Each scan bumps the generation, and the snapshot is kept until someone
+clears it, so a sync cycle scans once and everything in it sees the
+same answer.
+"""
+
+from __future__ import with_statement
+
+import logging
+import os
+
+from subprocess import PIPE, Popen
+from threading import Lock
+
+
+def parseStatus(stream, chunk_size=64*1024):
+    """Yields (kind, xy, path, original) for each record of porcelain v2
+    -z output read from stream.  kind is '1' (changed), '2' (renamed or
+    copied), 'u' (unmerged), '?' (untracked) or '!' (ignored).  xy is
+    the index and work tree status, '..' for untracked and ignored.
+    original is the old path of a rename, otherwise None."""
+    # how many space separated fields come before the path.
+    fields = {'1': 8, '2': 9, 'u': 10, '?': 1, '!': 1}
+    rest = ''
+    renamed = None
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            break
+        records = (rest + data).split('\0')
+        rest = records.pop()
+        for record in records:
+            if renamed is not None:
+                # the second half of a rename, the path it came from.
+                yield ('2', renamed[0], renamed[1], record)
+                renamed = None
+                continue
+            kind = record[:1]
+            if kind not in fields:
+                # headers and anything newer than us.
+                continue
+            parts = record.split(' ', fields[kind])
+            if kind in ('?', '!'):
+                yield (kind, '..', parts[1], None)
+            elif kind == '2':
+                renamed = (parts[1], parts[9])
+            else:
+                yield (kind, parts[1], parts[fields[kind]], None)
+
+
+class StatusSnapshot(object):
+    def __init__(self, generation):
+        self.generation = generation
+        self.staged = 0      # paths with changes in the index.
+        self.unstaged = 0    # tracked paths changed in the work tree.
+        self.unmerged = 0
+        self.untracked = []  # an untracked directory is one entry.
+
+    def add(self, kind, xy, path):
+        if kind == '?':
+            self.untracked.append(path)
+        elif kind == 'u':
+            self.unmerged = self.unmerged + 1
+        elif kind != '!':
+            if xy[0] != '.':
+                self.staged = self.staged + 1
+            if xy[1] != '.':
+                self.unstaged = self.unstaged + 1
+
+    def changed(self):
+        return (self.staged + self.unstaged + self.unmerged + len(self.untracked)) > 0
+
+
+class GitStatus(object):
+    command = ['git', 'status', '--porcelain=v2', '-z']
+
+    def __init__(self, path):
+        # the rest of GitRepo runs git in the current directory.
+        if not os.getcwd() == path:
+            os.chdir(path)
+        self.path = path
+        self.lock = Lock()
+        self.generation = 0
+        self.snapshot = None
+
+    def entries(self):
+        """Streams the status records, see parseStatus."""
+        proc = Popen(self.command, cwd=self.path, stdout=PIPE)
+        try:
+            for entry in parseStatus(proc.stdout):
+                yield entry
+        finally:
+            proc.stdout.close()
+            if proc.wait() != 0:
+                logging.warning('%s exited with %d', ' '.join(self.command), proc.returncode)
+
+    def scan(self):
+        """Run git status now and return the new snapshot."""
+        with self.lock:
+            self.generation = self.generation + 1
+            snapshot = StatusSnapshot(self.generation)
+            for (kind, xy, path, original) in self.entries():
+                snapshot.add(kind, xy, path)
+            self.snapshot = snapshot
+            logging.debug('status %d: %d staged, %d unstaged, %d unmerged, %d untracked',
+                          snapshot.generation, snapshot.staged, snapshot.unstaged,
+                          snapshot.unmerged, len(snapshot.untracked))
+            return snapshot
+
+    def current(self):
+        """The last snapshot, scanning only if it's been cleared."""
+        snapshot = self.snapshot
+        if snapshot is not None:
+            return snapshot
+        return self.scan()
+
+    def clear(self):
+        """Something changed, the next current() has to look again."""
+        self.snapshot = None
+
+    def stats(self):
+        return {'generation': self.generation}
@@ -0,0 +1,118 @@
+#!/usr/bin/env python2
+# GroupSync.py  -*- python -*-
+# Copyright (c) 2013 Ross Biro
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+"""GroupSync implements the batched durability mode.  Instead of an
+fsync on every close, the descriptor is dup'ed and queued.  A background
+thread flushes the queue once per interval, and the sync thread flushes
+it before it commits.
+
+Small batches get an fsync per descriptor.  Big ones get a single
+syncfs on the shadow directory's filesystem when libc has it.  A batch
+that fills up is synced right away by whoever adds to it, so the queue
+never holds more than max_queued descriptors open.
+"""
+
+import logging
+import os
+
+from ctypes import CDLL, c_int, get_errno
+from ctypes.util import find_library
+from threading import Event, Lock, Thread
+from time import sleep
+
+try:
+    _syncfs = CDLL(find_library('c'), use_errno=True).syncfs
+    _syncfs.argtypes = [c_int]
+    _syncfs.restype = c_int
+except AttributeError:
+    # not linux, or an old libc.
+    _syncfs = None
+
+def syncfs(fd):
+    if _syncfs(fd) != 0:
+        e = get_errno()
+        raise OSError(e, os.strerror(e))
+
+
+class GroupSync(object):
+    # with more than this many descriptors queued it's cheaper to sync the whole filesystem.
+    syncfs_threshold = 16
+    # each queued descriptor is an open file, so never hold more than this many.
+    max_queued = 256
+
+    def __init__(self, root, interval=1):
+        self.root = root
+        self.interval = interval
+        self.fds = []
+        self.lock = Lock()
+        self.pending = Event()
+        self.halt = False
+        self.thread = Thread(target=self._run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, fd):
+        """Queue fd to be synced.  The caller is free to close fd as soon
+        as this returns."""
+        with self.lock:
+            if len(self.fds) < self.max_queued:
+                self.fds.append(os.dup(fd))
+                fd = None
+        if fd is None:
+            self.pending.set()
+            return
+        # the queue is full, sync it now rather than dup any more.
+        self.flush()
+        os.fsync(fd)
+
+    def flush(self):
+        with self.lock:
+            fds = self.fds
+            self.fds = []
+        if len(fds) == 0:
+            return
+
+        try:
+            if _syncfs is not None and len(fds) > self.syncfs_threshold:
+                rfd = os.open(self.root, os.O_RDONLY)
+                try:
+                    syncfs(rfd)
+                finally:
+                    os.close(rfd)
+            else:
+                for fd in fds:
+                    os.fsync(fd)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def stop(self):
+        self.halt = True
+        self.pending.set()
+        self.flush()
+
+    def _run(self):
+        while not self.halt:
+            self.pending.wait()
+            # give the batch a chance to fill up.
+            sleep(self.interval)
+            self.pending.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                logging.debug('group sync failed: %s', e)
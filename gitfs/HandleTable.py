@@ -0,0 +1,93 @@
+#!/usr/bin/env python2
+# HandleTable.py  -*- python -*-
+# Copyright (c) 2013 Ross Biro
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+"""HandleTable keeps what GitFS knows about each open file handle.
+
+The handles GitFS gives out are the shadow file descriptors themselves,
+so anything that only needs the file (fstat, ftruncate, fsync) can use
+the handle instead of going back through the path.  The table remembers
+how a handle was opened and whether anything has been written through
+it since it was last made durable, so a flush on a handle that only
+read, the common case for editors and compilers, doesn't fsync.  An
+explicit fsync always syncs, it has to cover writes through any handle.
+"""
+
+import os
+
+# python 2's os doesn't have it.
+O_ACCMODE = getattr(os, 'O_ACCMODE', os.O_RDONLY | os.O_WRONLY | os.O_RDWR)
+
+
+class Handle(object):
+    def __init__(self, fh, flags):
+        self.fh = fh
+        self.flags = flags
+        # anything to make durable since the last flush or fsync.  Creating
+        # or truncating the file counts.
+        self.written = flags & (os.O_CREAT | os.O_TRUNC) != 0
+
+    def writable(self):
+        return self.flags & O_ACCMODE != os.O_RDONLY
+
+
+class HandleTable(object):
+    def __init__(self):
+        # a handle is only added by open/create and removed by release,
+        # which the kernel never runs at the same time for one handle.
+        self.handles = {}
+        self.opens = 0
+        self.syncs_skipped = 0
+
+    def add(self, fh, flags):
+        handle = Handle(fh, flags)
+        self.handles[fh] = handle
+        self.opens = self.opens + 1
+        return handle
+
+    def get(self, fh):
+        return self.handles.get(fh)
+
+    def remove(self, fh):
+        self.handles.pop(fh, None)
+
+    def written(self, fh):
+        handle = self.handles.get(fh)
+        if handle is not None:
+            handle.written = True
+
+    def needsSync(self, fh):
+        """Whether fh has anything to make durable.  Clears the flag, a
+        write that comes in while we sync sets it again."""
+        handle = self.handles.get(fh)
+        if handle is None:
+            # not one of ours, be safe.
+            return True
+        if not handle.written:
+            self.syncs_skipped = self.syncs_skipped + 1
+            return False
+        handle.written = False
+        return True
+
+    def synced(self, fh):
+        """fh was just synced whether it needed it or not."""
+        handle = self.handles.get(fh)
+        if handle is not None:
+            handle.written = False
+
+    def stats(self):
+        return {'open': len(self.handles), 'opens': self.opens, 'syncs_skipped': self.syncs_skipped}
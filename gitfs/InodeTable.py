@@ -0,0 +1,127 @@
+#!/usr/bin/env python2
+# InodeTable.py  -*- python -*-
+# Copyright (c) 2013 Ross Biro
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+"""InodeTable maps the node ids the kernel uses with the low level FUSE
+interface to shadow paths.
+
+Every successful lookup hands the kernel a reference on a node, and
+forget gives them back.  A node stays in the table until the kernel has
+forgotten all of its references, so the kernel can keep using an id
+after the name is gone.  Ids are never reused while we're mounted.
+
+Each node keeps its full shadow path, so an operation on a node never
+has to rebuild or escape a path.  A rename rewrites the paths of the
+nodes below it.
+"""
+
+from threading import Lock
+
+ROOT_ID = 1
+
+
+class Inode(object):
+    def __init__(self, ino, path, parent, name):
+        self.ino = ino
+        self.path = path
+        self.parent = parent  # the parent Inode, None for the root.
+        self.name = name      # shadow name in the parent.
+        self.lookups = 0
+        self.children = {}    # shadow name -> Inode
+        self.seen = None      # (mtime, size) at the last open, for auto_cache.
+
+    def childPath(self, name):
+        if self.parent is None:
+            # the root is root + '/', the way GitFS sees it.
+            return self.path + name
+        return self.path + '/' + name
+
+
+class InodeTable(object):
+    def __init__(self, root):
+        self.lock = Lock()
+        self.root = Inode(ROOT_ID, root + '/', None, '')
+        self.inodes = {ROOT_ID: self.root}
+        self.paths = {self.root.path: self.root}
+        self.next_ino = ROOT_ID + 1
+
+    def get(self, ino):
+        """Raises KeyError for an id the kernel shouldn't have."""
+        return self.inodes[ino]
+
+    def byPath(self, path):
+        return self.paths.get(path)
+
+    def remember(self, parent, name):
+        """The kernel looked up name in parent and got an answer.  Returns
+        the node with one more reference."""
+        with self.lock:
+            inode = parent.children.get(name)
+            if inode is None:
+                inode = Inode(self.next_ino, parent.childPath(name), parent, name)
+                self.next_ino = self.next_ino + 1
+                self.inodes[inode.ino] = inode
+                self.paths[inode.path] = inode
+                parent.children[name] = inode
+            inode.lookups = inode.lookups + 1
+            return inode
+
+    def forget(self, ino, count):
+        with self.lock:
+            inode = self.inodes.get(ino)
+            if inode is None or inode is self.root:
+                return
+            inode.lookups = inode.lookups - count
+            if inode.lookups <= 0:
+                del self.inodes[ino]
+                if self.paths.get(inode.path) is inode:
+                    del self.paths[inode.path]
+                if inode.parent.children.get(inode.name) is inode:
+                    del inode.parent.children[inode.name]
+
+    def remove(self, parent, name):
+        """name is gone from parent.  The node lives on until it's forgotten."""
+        with self.lock:
+            inode = parent.children.pop(name, None)
+            if inode is not None and self.paths.get(inode.path) is inode:
+                del self.paths[inode.path]
+
+    def rename(self, parent, name, new_parent, new_name):
+        with self.lock:
+            # whatever was at the new name has been replaced.
+            old = new_parent.children.pop(new_name, None)
+            if old is not None and self.paths.get(old.path) is old:
+                del self.paths[old.path]
+            inode = parent.children.pop(name, None)
+            if inode is None:
+                return
+            inode.parent = new_parent
+            inode.name = new_name
+            new_parent.children[new_name] = inode
+            self._move(inode, new_parent.childPath(new_name))
+
+    def _move(self, inode, path):
+        """Called with the lock held."""
+        if self.paths.get(inode.path) is inode:
+            del self.paths[inode.path]
+        inode.path = path
+        self.paths[path] = inode
+        for child in inode.children.itervalues():
+            self._move(child, inode.childPath(child.name))
+
+    def stats(self):
+        return {'inodes': len(self.inodes)}
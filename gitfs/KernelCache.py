@@ -0,0 +1,119 @@
+#!/usr/bin/env python2
+# KernelCache.py  -*- python -*-
+# Copyright (c) 2013 Ross Biro
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+"""KernelCache decides how much the kernel may cache for us, and tells
+it when something changed behind its back.
+
+Almost every change goes through the mount, so the kernel already knows
+about it.  The exceptions are pulls and whatever a control socket client
+does while it holds the lock.  For those GitFS works out which paths
+changed and passes them to invalidate.
+
+When libfuse has fuse_invalidate_path, or we're mounted through the low
+level interface (LowLevel.py), the kernel can be told exactly
+what changed, so it gets long entry and attribute timeouts and keeps
+file pages between opens (kernel_cache).  Without it there is no way to
+reach the kernel's caches, so we ask for auto_cache, which drops a
+file's pages when its mtime or size has changed at open, and keep the
+timeouts short.
+
+writeback turns on the kernel's write-back cache, where the kernel
+collects small writes into big ones and keeps track of mtime and size
+itself.  Only libfuse 3 has the option.
+"""
+
+import logging
+import os
+
+from errno import ENOENT
+from ctypes import c_char_p, c_int, c_void_p
+
+try:
+    from fuse import _libfuse
+except ImportError:
+    _libfuse = None
+
+try:
+    _invalidate_path = _libfuse.fuse_invalidate_path
+    _invalidate_path.argtypes = [c_void_p, c_char_p]
+    _invalidate_path.restype = c_int
+except AttributeError:
+    # libfuse 2 doesn't have it, and neither does a missing libfuse.
+    _invalidate_path = None
+
+# fuse_invalidate_path came with libfuse 3.
+libfuse3 = _invalidate_path is not None
+
+
+class KernelCache(object):
+    # how long the kernel trusts names and attributes when we can't invalidate them.
+    short_timeout = 1
+
+    def __init__(self, timeout, writeback=False, lowlevel=False):
+        self.timeout = timeout
+        # the low level interface can always tell the kernel what changed.
+        self.targeted = _invalidate_path is not None or lowlevel
+        self.notify = None
+        self.writeback = writeback and libfuse3
+        if writeback and not libfuse3:
+            logging.warning('writeback_cache needs libfuse 3, mounting without it')
+        self.fuse = None
+        self.invalidations = 0
+
+    def mountOptions(self):
+        """FUSE options to mount with.  Anything the user gives wins."""
+        if self.targeted:
+            options = {'kernel_cache': True, 'entry_timeout': self.timeout,
+                       'attr_timeout': self.timeout}
+        else:
+            options = {'auto_cache': True, 'entry_timeout': self.short_timeout,
+                       'attr_timeout': self.short_timeout}
+        if self.writeback:
+            options['writeback_cache'] = True
+        return options
+
+    def attach(self):
+        """Grab the fuse handle.  Only works from inside a FUSE operation,
+        GitFS.init calls it."""
+        if self.targeted:
+            self.fuse = c_void_p(_libfuse.fuse_get_context().contents.fuse)
+
+    def attachLowLevel(self, notify):
+        """LowLevel mounts pass in their own way of telling the kernel."""
+        self.notify = notify
+
+    def invalidate(self, paths):
+        """paths are mount relative ('/a/b') and changed without the kernel
+        seeing it."""
+        if self.notify is not None:
+            self.notify(paths)
+            self.invalidations = self.invalidations + len(paths)
+            return
+        if self.fuse is None:
+            return
+        for path in paths:
+            r = _invalidate_path(self.fuse, path)
+            # -ENOENT just means the kernel had nothing cached for it.
+            if r != 0 and -r != ENOENT:
+                logging.debug('fuse_invalidate_path(%s) failed: %s', path, os.strerror(-r))
+            self.invalidations = self.invalidations + 1
+
+    def stats(self):
+        return {'targeted': self.targeted and 'yes' or 'no', 'timeout': self.timeout,
+                'writeback': self.writeback and 'yes' or 'no',
+                'invalidations': self.invalidations}
@@ -0,0 +1,123 @@
+#!/usr/bin/env python2
+# LRUCache.py  -*- python -*-
+# Copyright (c) 2013 Ross Biro
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+"""LRUCache exports a small thread safe, bounded, least recently used
+cache keyed by path.  It keeps hit and miss counters so the size can be
+tuned from the numbers reported over the control socket.
+
+Invalidation bumps a generation counter.  Callers that fill the cache
+after a miss should grab the generation before doing the expensive
+lookup and pass it to put, so a value computed before an invalidation
+can't be stored after it.
+"""
+
+from threading import Lock
+
+
+# A hit has to be cheap since the path translation caches see one on
+# every operation, so recency is kept in a circular doubly linked list of
+# [prev, next, key, value] lists rather than an OrderedDict.
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+class LRUCache(object):
+    def __init__(self, size):
+        self.size = size
+        self.map = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.lock = Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.map)
+
+    def __contains__(self, key):
+        return key in self.map
+
+    def _unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def _append(self, link):
+        last = self.root[PREV]
+        link[PREV] = last
+        link[NEXT] = self.root
+        last[NEXT] = self.root[PREV] = link
+
+    def get(self, key, default=None):
+        with self.lock:
+            link = self.map.get(key)
+            if link is None:
+                self.misses = self.misses + 1
+                return default
+            self._unlink(link)
+            self._append(link)
+            self.hits = self.hits + 1
+            return link[VALUE]
+
+    def put(self, key, value, generation=None):
+        if self.size <= 0:
+            return
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            link = self.map.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[VALUE] = value
+            else:
+                link = [None, None, key, value]
+                self.map[key] = link
+            self._append(link)
+            while len(self.map) > self.size:
+                oldest = self.root[NEXT]
+                self._unlink(oldest)
+                del self.map[oldest[KEY]]
+
+    def _discard(self, key):
+        link = self.map.pop(key, None)
+        if link is not None:
+            self._unlink(link)
+
+    def discard(self, key):
+        with self.lock:
+            self.generation = self.generation + 1
+            self._discard(key)
+
+    def discardTree(self, path):
+        """Remove path and everything below it."""
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            self.generation = self.generation + 1
+            self._discard(path)
+            for key in [k for k in self.map if k.startswith(prefix)]:
+                self._discard(key)
+
+    def clear(self):
+        with self.lock:
+            self.generation = self.generation + 1
+            self.map.clear()
+            self.root[:] = [self.root, self.root, None, None]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': self.size, 'entries': len(self.map),
+                'hits': self.hits, 'misses': self.misses,
+                'hit_rate': '%.3f' %(lookups and float(self.hits) / lookups or 0.0)}
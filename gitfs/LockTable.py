@@ -0,0 +1,57 @@
+#!/usr/bin/env python2
+# LockTable.py  -*- python -*-
+# Copyright (c) 2013 Ross Biro
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+"""LockTable serializes operations on the same path without a lock per
+path.  Paths hash onto a fixed set of stripes, so two operations only
+wait for each other when their paths land on the same stripe, which for
+unrelated paths is rare with enough stripes.
+
+hold takes the stripes for all of its paths in index order, so
+operations that need two paths (rename, link) can't deadlock with each
+other.
+"""
+
+from __future__ import with_statement
+
+from contextlib import contextmanager
+from threading import Lock
+
+
+class LockTable(object):
+    def __init__(self, stripes=256):
+        self.locks = [Lock() for i in range(stripes)]
+        self.waits = 0
+
+    @contextmanager
+    def hold(self, *paths):
+        stripes = sorted(set([hash(path) % len(self.locks) for path in paths]))
+        held = []
+        try:
+            for n in stripes:
+                lock = self.locks[n]
+                if not lock.acquire(False):
+                    self.waits = self.waits + 1
+                    lock.acquire()
+                held.append(lock)
+            yield
+        finally:
+            for lock in reversed(held):
+                lock.release()
+
+    def stats(self):
+        return {'stripes': len(self.locks), 'waits': self.waits}
@@ -0,0 +1,524 @@
+#!/usr/bin/env python2
+# LowLevel.py  -*- python -*-
+# Copyright (c) 2013 Ross Biro
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+"""LowLevel mounts a GitFS through libfuse's low level, inode based
+interface instead of fusepy's path based one.
+
+With the path interface, libfuse builds the full path for every
+operation and GitFS escapes it again.  Here the kernel talks in node
+ids.  An InodeTable turns an id into its shadow path with one dict
+lookup.  A lookup only escapes the one name being looked up.  The work
+itself is still done by the GitFS operations, so the caches, the dirty
+tracker and everything else behave the same either way.
+
+It also means GitFS can tell the kernel exactly what a pull changed
+(fuse_lowlevel_notify_inval_*), even with libfuse 2.
+
+LowLevel takes the same arguments as fusepy's FUSE.  gmount uses it when
+the lowlevel option is set.  The path interface is still the default.
+"""
+
+import logging
+
+from ctypes import CFUNCTYPE, POINTER, Structure, addressof, byref, c_char_p, c_double, \
+    c_int, c_size_t, c_ulong, c_void_p, create_string_buffer, sizeof
+from errno import EIO, ENOENT, ESTALE
+from signal import signal, SIGINT, SIG_DFL
+from threading import local
+
+from fuse import _libfuse, c_dev_t, c_mode_t, c_off_t, c_stat, c_statvfs, fuse_file_info, set_st_attrs
+
+from gitfs.GitFSBase import escapeName, translatePath
+from gitfs.InodeTable import InodeTable
+
+c_ino_t = c_ulong
+c_req_t = c_void_p
+
+# to_set bits for setattr.
+FUSE_SET_ATTR_MODE = 1 << 0
+FUSE_SET_ATTR_UID = 1 << 1
+FUSE_SET_ATTR_GID = 1 << 2
+FUSE_SET_ATTR_SIZE = 1 << 3
+FUSE_SET_ATTR_ATIME = 1 << 4
+FUSE_SET_ATTR_MTIME = 1 << 5
+
+# what libfuse puts in d_ino when it doesn't know better.
+FUSE_UNKNOWN_INO = 0xffffffff
+
+
+class fuse_args(Structure):
+    _fields_ = [('argc', c_int), ('argv', POINTER(c_char_p)), ('allocated', c_int)]
+
+class fuse_entry_param(Structure):
+    _fields_ = [('ino', c_ino_t), ('generation', c_ulong), ('attr', c_stat),
+                ('attr_timeout', c_double), ('entry_timeout', c_double)]
+
+# struct fuse_lowlevel_ops from libfuse 2.9, in order.  The ones we don't
+# implement stay NULL.
+class fuse_lowlevel_ops(Structure):
+    _fields_ = [
+        ('init', CFUNCTYPE(None, c_void_p, c_void_p)),
+        ('destroy', CFUNCTYPE(None, c_void_p)),
+        ('lookup', CFUNCTYPE(None, c_req_t, c_ino_t, c_char_p)),
+        ('forget', CFUNCTYPE(None, c_req_t, c_ino_t, c_ulong)),
+        ('getattr', CFUNCTYPE(None, c_req_t, c_ino_t, POINTER(fuse_file_info))),
+        ('setattr', CFUNCTYPE(None, c_req_t, c_ino_t, POINTER(c_stat), c_int, POINTER(fuse_file_info))),
+        ('readlink', CFUNCTYPE(None, c_req_t, c_ino_t)),
+        ('mknod', CFUNCTYPE(None, c_req_t, c_ino_t, c_char_p, c_mode_t, c_dev_t)),
+        ('mkdir', CFUNCTYPE(None, c_req_t, c_ino_t, c_char_p, c_mode_t)),
+        ('unlink', CFUNCTYPE(None, c_req_t, c_ino_t, c_char_p)),
+        ('rmdir', CFUNCTYPE(None, c_req_t, c_ino_t, c_char_p)),
+        ('symlink', CFUNCTYPE(None, c_req_t, c_char_p, c_ino_t, c_char_p)),
+        ('rename', CFUNCTYPE(None, c_req_t, c_ino_t, c_char_p, c_ino_t, c_char_p)),
+        ('link', CFUNCTYPE(None, c_req_t, c_ino_t, c_ino_t, c_char_p)),
+        ('open', CFUNCTYPE(None, c_req_t, c_ino_t, POINTER(fuse_file_info))),
+        ('read', CFUNCTYPE(None, c_req_t, c_ino_t, c_size_t, c_off_t, POINTER(fuse_file_info))),
+        ('write', CFUNCTYPE(None, c_req_t, c_ino_t, c_void_p, c_size_t, c_off_t, POINTER(fuse_file_info))),
+        ('flush', CFUNCTYPE(None, c_req_t, c_ino_t, POINTER(fuse_file_info))),
+        ('release', CFUNCTYPE(None, c_req_t, c_ino_t, POINTER(fuse_file_info))),
+        ('fsync', CFUNCTYPE(None, c_req_t, c_ino_t, c_int, POINTER(fuse_file_info))),
+        ('opendir', CFUNCTYPE(None, c_req_t, c_ino_t, POINTER(fuse_file_info))),
+        ('readdir', CFUNCTYPE(None, c_req_t, c_ino_t, c_size_t, c_off_t, POINTER(fuse_file_info))),
+        ('releasedir', CFUNCTYPE(None, c_req_t, c_ino_t, POINTER(fuse_file_info))),
+        ('fsyncdir', CFUNCTYPE(None, c_req_t, c_ino_t, c_int, POINTER(fuse_file_info))),
+        ('statfs', CFUNCTYPE(None, c_req_t, c_ino_t)),
+        ('setxattr', c_void_p),
+        ('getxattr', c_void_p),
+        ('listxattr', c_void_p),
+        ('removexattr', c_void_p),
+        ('access', CFUNCTYPE(None, c_req_t, c_ino_t, c_int)),
+        ('create', CFUNCTYPE(None, c_req_t, c_ino_t, c_char_p, c_mode_t, POINTER(fuse_file_info))),
+        ('getlk', c_void_p),
+        ('setlk', c_void_p),
+        ('bmap', c_void_p),
+        ('ioctl', c_void_p),
+        ('poll', c_void_p),
+        ('write_buf', c_void_p),
+        ('retrieve_reply', c_void_p),
+        ('forget_multi', c_void_p),
+        ('flock', c_void_p),
+        ('fallocate', c_void_p)]
+
+def _declare(name, restype, *argtypes):
+    f = getattr(_libfuse, name)
+    f.restype = restype
+    f.argtypes = list(argtypes)
+    return f
+
+fuse_reply_err = _declare('fuse_reply_err', c_int, c_req_t, c_int)
+fuse_reply_none = _declare('fuse_reply_none', None, c_req_t)
+fuse_reply_entry = _declare('fuse_reply_entry', c_int, c_req_t, POINTER(fuse_entry_param))
+fuse_reply_create = _declare('fuse_reply_create', c_int, c_req_t, POINTER(fuse_entry_param),
+                             POINTER(fuse_file_info))
+fuse_reply_attr = _declare('fuse_reply_attr', c_int, c_req_t, POINTER(c_stat), c_double)
+fuse_reply_readlink = _declare('fuse_reply_readlink', c_int, c_req_t, c_char_p)
+fuse_reply_open = _declare('fuse_reply_open', c_int, c_req_t, POINTER(fuse_file_info))
+fuse_reply_write = _declare('fuse_reply_write', c_int, c_req_t, c_size_t)
+fuse_reply_buf = _declare('fuse_reply_buf', c_int, c_req_t, c_void_p, c_size_t)
+fuse_reply_statfs = _declare('fuse_reply_statfs', c_int, c_req_t, POINTER(c_statvfs))
+fuse_add_direntry = _declare('fuse_add_direntry', c_size_t, c_req_t, c_void_p, c_size_t, c_char_p,
+                             POINTER(c_stat), c_off_t)
+fuse_mount = _declare('fuse_mount', c_void_p, c_char_p, POINTER(fuse_args))
+fuse_unmount = _declare('fuse_unmount', None, c_char_p, c_void_p)
+fuse_lowlevel_new = _declare('fuse_lowlevel_new', c_void_p, POINTER(fuse_args),
+                             POINTER(fuse_lowlevel_ops), c_size_t, c_void_p)
+fuse_session_add_chan = _declare('fuse_session_add_chan', None, c_void_p, c_void_p)
+fuse_session_remove_chan = _declare('fuse_session_remove_chan', None, c_void_p)
+fuse_session_destroy = _declare('fuse_session_destroy', None, c_void_p)
+fuse_session_loop = _declare('fuse_session_loop', c_int, c_void_p)
+fuse_session_loop_mt = _declare('fuse_session_loop_mt', c_int, c_void_p)
+fuse_set_signal_handlers = _declare('fuse_set_signal_handlers', c_int, c_void_p)
+fuse_remove_signal_handlers = _declare('fuse_remove_signal_handlers', None, c_void_p)
+fuse_daemonize = _declare('fuse_daemonize', c_int, c_int)
+fuse_lowlevel_notify_inval_inode = _declare('fuse_lowlevel_notify_inval_inode', c_int, c_void_p,
+                                            c_ino_t, c_off_t, c_off_t)
+fuse_lowlevel_notify_inval_entry = _declare('fuse_lowlevel_notify_inval_entry', c_int, c_void_p,
+                                            c_ino_t, c_char_p, c_size_t)
+
+
+class LowLevel(object):
+    # options fusepy's FUSE takes as flags rather than -o options.
+    flags = (('foreground', '-f'), ('debug', '-d'))
+
+    # high level options that we have to do ourselves down here.
+    own_options = ('entry_timeout', 'attr_timeout', 'negative_timeout', 'kernel_cache',
+                   'auto_cache', 'nothreads')
+
+    def __init__(self, fs, mount_point, **options):
+        self.fs = fs
+        self.table = InodeTable(fs.root)
+        self.dirs = {}    # directory handle -> listing
+        self.next_dir = 1
+        self.entry_timeout = float(options.get('entry_timeout', 1))
+        self.attr_timeout = float(options.get('attr_timeout', 1))
+        self.negative_timeout = float(options.get('negative_timeout', 0))
+        self.kernel_cache = bool(options.get('kernel_cache', False))
+        self.auto_cache = bool(options.get('auto_cache', False))
+        self.chan = None
+        # a read buffer per libfuse thread.
+        self.buffers = local()
+
+        args = ['gitfs']
+        args.extend([flag for (name, flag) in self.flags if options.get(name, False)])
+        fuse_options = ['fsname=%s' %fs.__class__.__name__]
+        for (key, value) in options.iteritems():
+            if key in self.own_options or key in dict(self.flags) or value is False:
+                continue
+            if value is True:
+                fuse_options.append(key)
+            else:
+                fuse_options.append('%s=%s' %(key, value))
+        args.extend(['-o', ','.join(fuse_options)])
+        self.run(mount_point, args, not options.get('nothreads', False), options.get('foreground', False))
+
+    def _ops(self):
+        ops = fuse_lowlevel_ops()
+        for (name, prototype) in fuse_lowlevel_ops._fields_:
+            method = getattr(self, name, None)
+            if method is None or prototype is c_void_p:
+                continue
+            setattr(ops, name, prototype(method))
+        return ops
+
+    def run(self, mount_point, args, threaded, foreground):
+        argv = (c_char_p * len(args))(*args)
+        fargs = fuse_args(len(args), argv, 0)
+        # the callbacks have to outlive the session.
+        self.ops = self._ops()
+
+        self.chan = fuse_mount(mount_point, byref(fargs))
+        if not self.chan:
+            raise RuntimeError('fuse_mount(%s) failed' %mount_point)
+        try:
+            session = fuse_lowlevel_new(byref(fargs), byref(self.ops), sizeof(self.ops), None)
+            if not session:
+                raise RuntimeError('fuse_lowlevel_new failed')
+            # libfuse only installs its handlers over the default ones.
+            old_handler = signal(SIGINT, SIG_DFL)
+            fuse_set_signal_handlers(session)
+            fuse_session_add_chan(session, self.chan)
+            try:
+                fuse_daemonize(foreground and 1 or 0)
+                self.fs.kernel_cache.attachLowLevel(self.notify)
+                if threaded:
+                    err = fuse_session_loop_mt(session)
+                else:
+                    err = fuse_session_loop(session)
+            finally:
+                fuse_remove_signal_handlers(session)
+                signal(SIGINT, old_handler)
+                fuse_session_remove_chan(self.chan)
+                # this is what calls destroy.
+                fuse_session_destroy(session)
+        finally:
+            fuse_unmount(mount_point, self.chan)
+            self.chan = None
+        if err:
+            raise RuntimeError(err)
+
+    def notify(self, paths):
+        """Tell the kernel that mount relative paths changed without it."""
+        for path in paths:
+            inode = self.table.byPath(self.fs.root + translatePath(path, escapeName))
+            if inode is None:
+                # the kernel doesn't have an id for it, so it can't have anything cached.
+                continue
+            fuse_lowlevel_notify_inval_inode(self.chan, inode.ino, 0, 0)
+            if inode.parent is not None:
+                fuse_lowlevel_notify_inval_entry(self.chan, inode.parent.ino, inode.name, len(inode.name))
+
+    # Everything below runs on libfuse's threads and has to answer every
+    # request exactly once.
+
+    def _reply(self, req, func, *args):
+        try:
+            if self.fs.workers is not None:
+                with self.fs.workers:
+                    func(*args)
+            else:
+                func(*args)
+        except EnvironmentError as e:
+            fuse_reply_err(req, e.errno or EIO)
+        except KeyError:
+            # an id we don't know.
+            fuse_reply_err(req, ESTALE)
+        except Exception as e:
+            logging.exception('low level operation failed: %s', e)
+            fuse_reply_err(req, EIO)
+
+    def _fh(self, fi):
+        """The handle for requests that only sometimes come with one (fstat, ftruncate)."""
+        if fi:
+            return fi.contents.fh
+        return None
+
+    def _stat(self, inode, attrs):
+        st = c_stat()
+        set_st_attrs(st, attrs)
+        st.st_ino = inode.ino
+        return st
+
+    def _entry(self, parent, name):
+        """Look name up in parent and answer with an entry, or let the error through."""
+        path = parent.childPath(name)
+        attrs = self.fs.getattr(path)
+        inode = self.table.remember(parent, name)
+        e = fuse_entry_param()
+        e.ino = inode.ino
+        e.attr = self._stat(inode, attrs)
+        e.attr_timeout = self.attr_timeout
+        e.entry_timeout = self.entry_timeout
+        return (inode, e)
+
+    def init(self, userdata, conn):
+        pass
+
+    def destroy(self, userdata):
+        self.fs.destroy(None)
+
+    def lookup(self, req, parent, name):
+        def op():
+            try:
+                (inode, e) = self._entry(self.table.get(parent), escapeName(name))
+            except EnvironmentError as err:
+                if err.errno != ENOENT or self.negative_timeout <= 0:
+                    raise
+                # an entry with id 0 lets the kernel cache that it isn't there.
+                e = fuse_entry_param()
+                e.entry_timeout = self.negative_timeout
+            fuse_reply_entry(req, byref(e))
+        self._reply(req, op)
+
+    def forget(self, req, ino, nlookup):
+        self.table.forget(ino, nlookup)
+        fuse_reply_none(req)
+
+    def getattr(self, req, ino, fi):
+        def op():
+            inode = self.table.get(ino)
+            st = self._stat(inode, self.fs.getattr(inode.path, self._fh(fi)))
+            fuse_reply_attr(req, byref(st), self.attr_timeout)
+        self._reply(req, op)
+
+    def setattr(self, req, ino, attr, to_set, fi):
+        def op():
+            inode = self.table.get(ino)
+            path = inode.path
+            st = attr.contents
+            if to_set & FUSE_SET_ATTR_MODE:
+                self.fs.chmod(path, st.st_mode)
+            if to_set & (FUSE_SET_ATTR_UID | FUSE_SET_ATTR_GID):
+                uid = -1
+                gid = -1
+                if to_set & FUSE_SET_ATTR_UID:
+                    uid = st.st_uid
+                if to_set & FUSE_SET_ATTR_GID:
+                    gid = st.st_gid
+                self.fs.chown(path, uid, gid)
+            if to_set & FUSE_SET_ATTR_SIZE:
+                self.fs.truncate(path, st.st_size, self._fh(fi))
+            if to_set & (FUSE_SET_ATTR_ATIME | FUSE_SET_ATTR_MTIME):
+                current = self.fs.getattr(path)
+                atime = current['st_atime']
+                mtime = current['st_mtime']
+                if to_set & FUSE_SET_ATTR_ATIME:
+                    atime = st.st_atimespec.tv_sec + st.st_atimespec.tv_nsec / 1E9
+                if to_set & FUSE_SET_ATTR_MTIME:
+                    mtime = st.st_mtimespec.tv_sec + st.st_mtimespec.tv_nsec / 1E9
+                self.fs.utimens(path, (atime, mtime))
+            reply = self._stat(inode, self.fs.getattr(path, self._fh(fi)))
+            fuse_reply_attr(req, byref(reply), self.attr_timeout)
+        self._reply(req, op)
+
+    def readlink(self, req, ino):
+        self._reply(req, lambda: fuse_reply_readlink(req, self.fs.readlink(self.table.get(ino).path)))
+
+    def _made(self, req, parent, name, make):
+        def op():
+            parent_inode = self.table.get(parent)
+            shadow = escapeName(name)
+            make(parent_inode.childPath(shadow))
+            (inode, e) = self._entry(parent_inode, shadow)
+            fuse_reply_entry(req, byref(e))
+        self._reply(req, op)
+
+    def mknod(self, req, parent, name, mode, rdev):
+        self._made(req, parent, name, lambda path: self.fs.mknod(path, mode, rdev))
+
+    def mkdir(self, req, parent, name, mode):
+        self._made(req, parent, name, lambda path: self.fs.mkdir(path, mode))
+
+    def symlink(self, req, link, parent, name):
+        self._made(req, parent, name, lambda path: self.fs.symlink(path, link))
+
+    def link(self, req, ino, new_parent, new_name):
+        def make(path):
+            # looked up inside _reply so every request gets an answer.
+            try:
+                source = self.table.get(ino).path
+            except KeyError:
+                # forgotten, there's nothing left to link to.
+                raise EnvironmentError(ENOENT, 'unknown inode %d' %ino)
+            self.fs._link(path, source)
+        self._made(req, new_parent, new_name, make)
+
+    def _removed(self, req, parent, name, remove):
+        def op():
+            parent_inode = self.table.get(parent)
+            shadow = escapeName(name)
+            remove(parent_inode.childPath(shadow))
+            self.table.remove(parent_inode, shadow)
+            fuse_reply_err(req, 0)
+        self._reply(req, op)
+
+    def unlink(self, req, parent, name):
+        self._removed(req, parent, name, self.fs.unlink)
+
+    def rmdir(self, req, parent, name):
+        self._removed(req, parent, name, self.fs.rmdir)
+
+    def rename(self, req, parent, name, new_parent, new_name):
+        def op():
+            (p, np) = (self.table.get(parent), self.table.get(new_parent))
+            (shadow, new_shadow) = (escapeName(name), escapeName(new_name))
+            self.fs._rename(p.childPath(shadow), np.childPath(new_shadow))
+            self.table.rename(p, shadow, np, new_shadow)
+            fuse_reply_err(req, 0)
+        self._reply(req, op)
+
+    def _keepCache(self, inode, fi):
+        if self.kernel_cache:
+            fi.keep_cache = 1
+        elif self.auto_cache:
+            # keep the kernel's pages as long as the file looks the same as last time.
+            attrs = self.fs.getattr(inode.path)
+            seen = (attrs['st_mtime'], attrs['st_size'])
+            fi.keep_cache = inode.seen == seen and 1 or 0
+            inode.seen = seen
+
+    def open(self, req, ino, fi):
+        def op():
+            inode = self.table.get(ino)
+            info = fi.contents
+            info.fh = self.fs.open(inode.path, info.flags)
+            self._keepCache(inode, info)
+            fuse_reply_open(req, fi)
+        self._reply(req, op)
+
+    def create(self, req, parent, name, mode, fi):
+        def op():
+            parent_inode = self.table.get(parent)
+            shadow = escapeName(name)
+            info = fi.contents
+            info.fh = self.fs.create(parent_inode.childPath(shadow), mode, info.flags)
+            (inode, e) = self._entry(parent_inode, shadow)
+            fuse_reply_create(req, byref(e), fi)
+        self._reply(req, op)
+
+    def _buffer(self, size):
+        buf = getattr(self.buffers, 'buf', None)
+        if buf is None or len(buf) < size:
+            buf = create_string_buffer(size)
+            self.buffers.buf = buf
+        return buf
+
+    def read(self, req, ino, size, off, fi):
+        def op():
+            buf = self._buffer(size)
+            n = self.fs.readinto(self.table.get(ino).path, buf, size, off, fi.contents.fh)
+            fuse_reply_buf(req, buf, n)
+        self._reply(req, op)
+
+    def write(self, req, ino, buf, size, off, fi):
+        def op():
+            fuse_reply_write(req, self.fs.writefrom(self.table.get(ino).path, buf, size, off, fi.contents.fh))
+        self._reply(req, op)
+
+    def flush(self, req, ino, fi):
+        def op():
+            self.fs.flush(self.table.get(ino).path, fi.contents.fh)
+            fuse_reply_err(req, 0)
+        self._reply(req, op)
+
+    def release(self, req, ino, fi):
+        def op():
+            self.fs.release(self.table.get(ino).path, fi.contents.fh)
+            fuse_reply_err(req, 0)
+        self._reply(req, op)
+
+    def fsync(self, req, ino, datasync, fi):
+        def op():
+            self.fs.fsync(self.table.get(ino).path, datasync, fi.contents.fh)
+            fuse_reply_err(req, 0)
+        self._reply(req, op)
+
+    def opendir(self, req, ino, fi):
+        def op():
+            inode = self.table.get(ino)
+            # take the listing once, readdir hands it out a piece at a time.
+            listing = self.fs.readdir(inode.path, None)
+            with self.table.lock:
+                fh = self.next_dir
+                self.next_dir = self.next_dir + 1
+                self.dirs[fh] = listing
+            fi.contents.fh = fh
+            fuse_reply_open(req, fi)
+        self._reply(req, op)
+
+    def readdir(self, req, ino, size, off, fi):
+        def op():
+            listing = self.dirs[fi.contents.fh]
+            buf = create_string_buffer(size)
+            used = 0
+            st = c_stat()
+            for n in range(off, len(listing)):
+                entry = listing[n]
+                if isinstance(entry, str):
+                    (name, attrs) = (entry, None)
+                else:
+                    (name, attrs, offset) = entry
+                st.st_mode = attrs is not None and attrs['st_mode'] or 0
+                st.st_ino = FUSE_UNKNOWN_INO
+                need = fuse_add_direntry(req, addressof(buf) + used, size - used, name, byref(st), n + 1)
+                if need > size - used:
+                    break
+                used = used + need
+            fuse_reply_buf(req, buf.raw[:used], used)
+        self._reply(req, op)
+
+    def releasedir(self, req, ino, fi):
+        with self.table.lock:
+            self.dirs.pop(fi.contents.fh, None)
+        fuse_reply_err(req, 0)
+
+    def fsyncdir(self, req, ino, datasync, fi):
+        fuse_reply_err(req, 0)
+
+    def statfs(self, req, ino):
+        def op():
+            stv = c_statvfs()
+            for (key, value) in self.fs.statfs(self.fs.root).iteritems():
+                setattr(stv, key, value)
+            fuse_reply_statfs(req, byref(stv))
+        self._reply(req, op)
+
+    def access(self, req, ino, mask):
+        def op():
+            self.fs.access(self.table.get(ino).path, mask)
+            fuse_reply_err(req, 0)
+        self._reply(req, op)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python2
+# MapCache.py  -*- python -*-
+# Copyright (c) 2013 Ross Biro
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+"""MapCache serves reads of big files out of read-only mmaps.
+
+When a file of at least threshold bytes is opened read-only, it is
+mapped once and every handle on that path reads slices of the mapping
+instead of going through a read system call.  The total size of all
+mappings is capped at limit, the least recently used ones are unmapped
+to make room, and a mapping nobody has read for idle seconds is dropped.
+
+A mapping only knows the file as it was when it was mapped, so anything
+that changes the file (write, truncate, rename, unlink, a pull) has to
+drop it.  read returns None when there is no mapping, and the caller
+falls back to pread.
+"""
+
+import logging
+import mmap
+import os
+
+from threading import Event, Lock, Thread
+from time import time
+
+
+class Mapping(object):
+    def __init__(self, map, size):
+        self.map = map
+        self.size = size
+        self.used = time()
+
+
+class MapCache(object):
+    def __init__(self, limit, threshold=1024*1024, idle=60):
+        self.limit = limit
+        self.threshold = threshold
+        self.idle = idle
+        self.maps = {} # path -> Mapping
+        self.mapped = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.halt = Event()
+        self.thread = Thread(target=self._reap, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def opened(self, path, fh):
+        """Map path through fh if it is big enough and there is room."""
+        with self.lock:
+            if path in self.maps:
+                return
+        size = os.fstat(fh).st_size
+        if size < self.threshold or size > self.limit:
+            return
+
+        m = mmap.mmap(fh, size, mmap.MAP_SHARED, mmap.PROT_READ)
+        with self.lock:
+            if path in self.maps:
+                # someone else beat us to it.
+                m.close()
+                return
+            self._makeRoom(size)
+            self.maps[path] = Mapping(m, size)
+            self.mapped = self.mapped + size
+
+    def _makeRoom(self, size):
+        # there are never many mappings, so a scan is fine.
+        while self.mapped + size > self.limit and len(self.maps) > 0:
+            path = min(self.maps, key=lambda p: self.maps[p].used)
+            self._unmap(path)
+
+    def _unmap(self, path):
+        """Called with the lock held."""
+        entry = self.maps.pop(path)
+        self.mapped = self.mapped - entry.size
+        # a reader in the middle of a slice keeps the object alive, and a
+        # slice after the close raises ValueError, which read handles.
+        entry.map.close()
+
+    def read(self, path, size, offset):
+        entry = self.maps.get(path)
+        if entry is None:
+            self.misses = self.misses + 1
+            return None
+        entry.used = time()
+        try:
+            data = entry.map[offset:offset + size]
+        except ValueError:
+            # unmapped out from under us.
+            self.misses = self.misses + 1
+            return None
+        self.hits = self.hits + 1
+        return data
+
+    def drop(self, path):
+        if path not in self.maps:
+            # the usual case, and it's on the write path.
+            return
+        with self.lock:
+            if path in self.maps:
+                self._unmap(path)
+
+    def dropTree(self, path):
+        prefix = path + '/'
+        with self.lock:
+            for p in [p for p in self.maps if p == path or p.startswith(prefix)]:
+                self._unmap(p)
+
+    def clear(self):
+        with self.lock:
+            for p in self.maps.keys():
+                self._unmap(p)
+
+    def stop(self):
+        self.halt.set()
+        self.thread.join()
+        self.clear()
+
+    def _reap(self):
+        while not self.halt.wait(self.idle / 2.0):
+            expired = time() - self.idle
+            with self.lock:
+                for p in [p for (p, e) in self.maps.iteritems() if e.used < expired]:
+                    logging.debug('unmapping idle %s', p)
+                    self._unmap(p)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'limit': self.limit, 'mapped': self.mapped, 'files': len(self.maps),
+                'hits': self.hits, 'misses': self.misses,
+                'hit_rate': '%.3f' %(lookups and float(self.hits) / lookups or 0.0)}
@@ -20,6 +20,8 @@
 import logging
 import errno
 
+from gitfs.Trace import preview
+
 """Packetize
 
 This module exports a class for pulling packets out of a stream and passing them off to
@@ -56,7 +58,7 @@ class PacketizeMixIn:
         try:
             while True:
                 if self._packet_len == 0:
-                    logging.debug('getting packet length length_bytes = %s, bytes_in_buff = %s' %(self._length_bytes, len(self._buff)))
+                    logging.debug('getting packet length length_bytes = %s, bytes_in_buff = %s', self._length_bytes, len(self._buff))
                     red = self.request.recv(self._length_bytes - len(self._buff))
                     if len(red) == 0:
                         logging.debug("recv returned 0 length string.")
@@ -65,7 +67,7 @@ class PacketizeMixIn:
                     if len(self._buff) >= self._length_bytes:
                         for i in range (0, self._length_bytes):
                             self._packet_len = self._packet_len * 8 + ord (self._buff[i])
-                    logging.debug("packet_len = %s" %self._packet_len)
+                    logging.debug("packet_len = %s", self._packet_len)
                 else:
                     logging.debug("getting rest of packet")
                     red =self.request.recv(self._packet_len - len(self._buff))
@@ -74,10 +76,10 @@ class PacketizeMixIn:
                         #happens when the socket gets closed on us in the middle.
                         return False
                     self._buff = self._buff + red
-                    logging.debug("buff now: %s" %self._buff)
+                    logging.debug("buff now: %s", preview(self._buff, 64))
 
                     if len(self._buff) >= self._packet_len:
-                        logging.debug('buff_len = %s, packet_len = %s' %(len(self._buff), self._packet_len))
+                        logging.debug('buff_len = %s, packet_len = %s', len(self._buff), self._packet_len)
                         dfs = None
                         try:
                             dfs = self.dictFromString
@@ -93,7 +95,7 @@ class PacketizeMixIn:
                         return True
                     
         except IOError as ioe:
-            logging.debug ("ioerror: %s" %ioe)
+            logging.debug("ioerror: %s", ioe)
             if ioe.errno != errno.EAGAIN and ioe.errno != errno.EWOULDBLOCK:
                 raise ioe
         
@@ -106,7 +108,7 @@ class PacketizeMixIn:
         for i in range (0, self._length_bytes):
             data = chr(dl & 0xff) + data
             dl = dl >> 8
-        logging.debug('Sending %s bytes' %(len(data)))
+        logging.debug('Sending %s bytes', len(data))
         self.request.sendall(data)
 
     def sendDict(self, dict):
@@ -0,0 +1,200 @@
+#!/usr/bin/env python2
+# PosIO.py  -*- python -*-
+# Copyright (c) 2013 Ross Biro
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+"""PosIO exports pread and pwrite for raw file descriptors.
+
+Unlike an lseek followed by a read or write, positional I/O never
+touches the shared file offset, so any number of threads can use the
+same descriptor at the same time without holding a lock.
+
+os.pread and os.pwrite are used when python has them.  Otherwise the
+libc versions are called through ctypes, which drops the GIL for the
+length of the call so the I/O itself still runs in parallel.
+
+preadinto and pwritefrom always go through libc.  They work on a caller's
+buffer, such as the one FUSE hands us, so the data never has to be
+copied into a python string.
+
+copyRange copies between two descriptors without the data coming up to
+python at all: a reflink clone (FICLONERANGE) where the filesystem can
+share blocks, copy_file_range where libc has it, and otherwise a
+chunked preadinto/pwritefrom through one reused buffer.
+"""
+
+import os
+import errno
+
+from ctypes import CDLL, POINTER, Structure, addressof, byref, c_int, c_int64, c_size_t, c_ssize_t
+from ctypes import c_uint, c_uint64, c_ulong, c_void_p, create_string_buffer, get_errno, string_at
+from ctypes.util import find_library
+from threading import local
+
+
+_libc = CDLL(find_library('c'), use_errno=True)
+
+# prefer the 64 bit versions so large files work on 32 bit hosts.
+_pread = getattr(_libc, 'pread64', None) or _libc.pread
+_pread.argtypes = [c_int, c_void_p, c_size_t, c_int64]
+_pread.restype = c_ssize_t
+
+_pwrite = getattr(_libc, 'pwrite64', None) or _libc.pwrite
+_pwrite.argtypes = [c_int, c_void_p, c_size_t, c_int64]
+_pwrite.restype = c_ssize_t
+
+def _retry(call, fd, buf, size, offset):
+    while True:
+        r = call(fd, buf, size, offset)
+        if r >= 0:
+            return r
+        e = get_errno()
+        if e != errno.EINTR:
+            raise OSError(e, os.strerror(e))
+
+def preadinto(fd, buf, size, offset):
+    """Read up to size bytes from fd at offset straight into buf, which
+    can be any ctypes buffer or pointer, or an address.  Returns the
+    number of bytes read."""
+    return _retry(_pread, fd, buf, size, offset)
+
+def pwritefrom(fd, buf, size, offset):
+    """Write size bytes from buf, as for preadinto, to fd at offset.
+    Returns the number of bytes written."""
+    return _retry(_pwrite, fd, buf, size, offset)
+
+
+# linux's FICLONERANGE, _IOW(0x94, 13, struct file_clone_range).
+FICLONERANGE = 0x4020940d
+
+class file_clone_range(Structure):
+    _fields_ = [('src_fd', c_int64), ('src_offset', c_uint64),
+                ('src_length', c_uint64), ('dest_offset', c_uint64)]
+
+_ioctl = _libc.ioctl
+_ioctl.argtypes = [c_int, c_ulong, c_void_p]
+_ioctl.restype = c_int
+
+# glibc 2.27 and later.
+_copy_file_range = getattr(_libc, 'copy_file_range', None)
+if _copy_file_range is not None:
+    _copy_file_range.argtypes = [c_int, POINTER(c_int64), c_int, POINTER(c_int64), c_size_t, c_uint]
+    _copy_file_range.restype = c_ssize_t
+
+# errors that mean the method isn't available for these files, not that the copy failed.
+_unsupported = (errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL)
+
+# filesystems (st_dev) we've found can't clone.
+_no_clone = set()
+
+_copy_chunk = 1024 * 1024
+_copy_buffers = local()
+
+def _clone(fd_in, off_in, fd_out, off_out, size):
+    """Returns the number of bytes cloned, or None if the filesystem
+    can't do it."""
+    st = os.fstat(fd_in)
+    if st.st_dev in _no_clone:
+        return None
+    size = min(size, st.st_size - off_in)
+    if size <= 0:
+        return 0
+    arg = file_clone_range(fd_in, off_in, size, off_out)
+    if _ioctl(fd_out, FICLONERANGE, byref(arg)) == 0:
+        return size
+    e = get_errno()
+    if e in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV):
+        _no_clone.add(st.st_dev)
+    elif e not in _unsupported:
+        # EINVAL is usually just offsets that aren't block aligned.
+        raise OSError(e, os.strerror(e))
+    return None
+
+def _copyFileRange(fd_in, off_in, fd_out, off_out, size):
+    """Returns the number of bytes copied, or None if the kernel
+    can't do it for these files."""
+    global _copy_file_range
+    if _copy_file_range is None:
+        return None
+    (pos_in, pos_out) = (c_int64(off_in), c_int64(off_out))
+    done = 0
+    while done < size:
+        r = _copy_file_range(fd_in, byref(pos_in), fd_out, byref(pos_out), size - done, 0)
+        if r == 0:
+            break
+        if r < 0:
+            e = get_errno()
+            if e == errno.EINTR:
+                continue
+            if done == 0 and e in _unsupported:
+                if e == errno.ENOSYS:
+                    _copy_file_range = None
+                return None
+            raise OSError(e, os.strerror(e))
+        done = done + r
+    return done
+
+def _copyChunks(fd_in, off_in, fd_out, off_out, size):
+    buf = getattr(_copy_buffers, 'buf', None)
+    if buf is None:
+        buf = create_string_buffer(_copy_chunk)
+        _copy_buffers.buf = buf
+    done = 0
+    while done < size:
+        n = preadinto(fd_in, buf, min(_copy_chunk, size - done), off_in + done)
+        if n == 0:
+            break
+        written = 0
+        while written < n:
+            written = written + pwritefrom(fd_out, addressof(buf) + written, n - written,
+                                           off_out + done + written)
+        done = done + n
+    return done
+
+def copyRange(fd_in, off_in, fd_out, off_out, size):
+    """Copy size bytes from fd_in at off_in to fd_out at off_out.
+    Returns the number of bytes copied, which is short only at the end
+    of fd_in."""
+    for method in (_clone, _copyFileRange, _copyChunks):
+        r = method(fd_in, off_in, fd_out, off_out, size)
+        if r is not None:
+            return r
+
+
+if hasattr(os, 'pread') and hasattr(os, 'pwrite'):
+    pread = os.pread
+    pwrite = os.pwrite
+
+else:
+    # each thread keeps its own scratch buffer so we don't pay for
+    # allocating and zeroing a new one on every read.
+    _buffers = local()
+
+    def _buffer(size):
+        buf = getattr(_buffers, 'buf', None)
+        if buf is None or len(buf) < size:
+            buf = create_string_buffer(size)
+            _buffers.buf = buf
+        return buf
+
+    def pread(fd, size, offset):
+        """Read up to size bytes from fd at offset.  Returns a string."""
+        buf = _buffer(size)
+        return string_at(buf, preadinto(fd, buf, size, offset))
+
+    def pwrite(fd, data, offset):
+        """Write data to fd at offset.  Returns the number of bytes written."""
+        return pwritefrom(fd, data, len(data), offset)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python2
+# ReadAhead.py  -*- python -*-
+# Copyright (c) 2013 Ross Biro
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+"""ReadAhead watches how each file handle is read.  Once a handle has
+made a few reads in a row that each start where the last one ended, a
+worker thread starts reading ahead of it, and later reads are served
+from what was fetched.
+
+The window starts small and doubles with every prefetch up to the
+maximum, and a handle never holds much more than two windows.  A read
+anywhere else resets the handle to plain preads.
+
+Anything that changes a file must call invalidate so nobody is served
+stale data, and release must be called before the handle is closed so
+a worker isn't left reading a closed descriptor.
+"""
+
+import logging
+
+from Queue import Queue
+from threading import Condition, Lock, Thread
+
+from gitfs.PosIO import pread
+
+
+class Stream(object):
+    def __init__(self, path, window):
+        self.path = path
+        self.lock = Lock()
+        self.fetched = Condition(self.lock)
+        self.last_end = None
+        self.streak = 0
+        self.window = window
+        # data holds the file from offset on.
+        self.offset = 0
+        self.data = ''
+        self.eof = False
+        self.fetching = False
+        self.fetch_end = 0
+        # bumped whenever data becomes stale, so a fetch in flight knows to throw its result away.
+        self.generation = 0
+
+    def end(self):
+        return self.offset + len(self.data)
+
+    def reset(self):
+        """Called with the lock held."""
+        self.generation = self.generation + 1
+        self.data = ''
+        self.eof = False
+
+
+class ReadAhead(object):
+    # reads in a row that have to be sequential before we start prefetching.
+    sequential_after = 2
+
+    def __init__(self, max_window, min_window=128*1024, workers=2):
+        self.max_window = max_window
+        self.min_window = min(min_window, max_window)
+        self.streams = {} # fh -> Stream
+        self.paths = {}   # path -> set of fh, writes check this on every call.
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.prefetches = 0
+        self.queue = Queue()
+        self.workers = [Thread(target=self._work, args=()) for i in range(workers)]
+        for t in self.workers:
+            t.daemon = True
+            t.start()
+
+    def _stream(self, fh, path):
+        with self.lock:
+            s = self.streams.get(fh)
+            if s is None:
+                s = self.streams[fh] = Stream(path, self.min_window)
+                self.paths.setdefault(path, set()).add(fh)
+            return s
+
+    def read(self, fh, path, size, offset):
+        s = self._stream(fh, path)
+        with s.lock:
+            # the read we want may be on its way.
+            while s.fetching and s.end() <= offset < s.fetch_end:
+                s.fetched.wait()
+
+            if s.offset <= offset and (offset + size <= s.end() or (s.eof and offset <= s.end())):
+                start = offset - s.offset
+                data = s.data[start:start + size]
+                s.last_end = offset + len(data)
+                self.hits = self.hits + 1
+                if not s.fetching and not s.eof and s.end() - s.last_end < s.window / 2:
+                    self._prefetch(fh, s)
+                return data
+
+            self.misses = self.misses + 1
+            if offset == s.last_end:
+                s.streak = s.streak + 1
+            else:
+                s.streak = 0
+                s.window = self.min_window
+                s.reset()
+            sequential = s.streak >= self.sequential_after
+
+        data = pread(fh, size, offset)
+        with s.lock:
+            s.last_end = offset + len(data)
+            if sequential and not s.fetching:
+                s.reset()
+                s.offset = s.last_end
+                if len(data) == size:
+                    self._prefetch(fh, s)
+        return data
+
+    def _prefetch(self, fh, s):
+        """Queue a read of the next window past what s holds.  Called with
+        s.lock held."""
+        start = s.end()
+        s.fetching = True
+        s.fetch_end = start + s.window
+        self.queue.put((fh, s, s.generation, start, s.window))
+        s.window = min(s.window * 2, self.max_window)
+        self.prefetches = self.prefetches + 1
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            (fh, s, generation, start, size) = job
+            try:
+                data = pread(fh, size, start)
+            except OSError as e:
+                logging.debug('read ahead of %s failed: %s', s.path, e)
+                data = None
+
+            with s.lock:
+                if data is not None and generation == s.generation and start == s.end():
+                    # drop whatever has already been read.
+                    consumed = max(0, min(s.last_end - s.offset, len(s.data)))
+                    s.data = s.data[consumed:] + data
+                    s.offset = s.offset + consumed
+                    s.eof = len(data) < size
+                s.fetching = False
+                s.fetched.notify_all()
+
+    def invalidate(self, path):
+        """path changed, forget anything read ahead from it."""
+        if path not in self.paths:
+            return
+        with self.lock:
+            streams = [self.streams[fh] for fh in self.paths.get(path, ())]
+        for s in streams:
+            with s.lock:
+                s.reset()
+
+    def invalidateAll(self):
+        with self.lock:
+            streams = self.streams.values()
+        for s in streams:
+            with s.lock:
+                s.reset()
+
+    def release(self, fh):
+        with self.lock:
+            s = self.streams.pop(fh, None)
+            if s is not None:
+                fhs = self.paths[s.path]
+                fhs.discard(fh)
+                if len(fhs) == 0:
+                    del self.paths[s.path]
+        if s is None:
+            return
+        with s.lock:
+            s.reset()
+            # the caller is about to close fh.
+            while s.fetching:
+                s.fetched.wait()
+
+    def stop(self):
+        for t in self.workers:
+            self.queue.put(None)
+
+    def stats(self):
+        reads = self.hits + self.misses
+        return {'max_window': self.max_window, 'handles': len(self.streams), 'hits': self.hits,
+                'misses': self.misses, 'prefetches': self.prefetches,
+                'hit_rate': '%.3f' %(reads and float(self.hits) / reads or 0.0)}
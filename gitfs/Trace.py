@@ -0,0 +1,46 @@
+#!/usr/bin/env python2
+# Trace.py  -*- python -*-
+# Copyright (c) 2013 Ross Biro
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+"""Trace is the switch for logging on the filesystem hot path.
+
+Code that runs on every FUSE operation checks Trace.enabled before it
+builds any log message, so tracing costs one attribute lookup when it is
+off.  It can be turned on and off at runtime through the control socket
+('trace' action) or at mount time with the trace option.
+
+preview formats a value for the log without ever copying more than a few
+bytes of it, which matters for read results and write buffers.
+"""
+
+import logging
+
+enabled = False
+
+def setEnabled(on):
+    global enabled
+    enabled = on and logging.getLogger().isEnabledFor(logging.DEBUG)
+    return enabled
+
+def preview(value, length=10):
+    if isinstance(value, basestring) or isinstance(value, bytearray):
+        if len(value) > length:
+            return '%r... (%d bytes)' %(value[:length], len(value))
+        return repr(value)
+    if isinstance(value, (list, tuple, dict)):
+        return '<%s of %d>' %(type(value).__name__, len(value))
+    return ('%s' %value)[:length]
@@ -0,0 +1,214 @@
+#!/usr/bin/env python2
+# WriteBuffer.py  -*- python -*-
+# Copyright (c) 2013 Ross Biro
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+"""WriteBuffer holds small sequential writes in memory and hands them
+to the shadow file as large, chunk aligned writes.
+
+Each file handle gets at most one buffer covering a single contiguous
+range.  A write that doesn't continue where the buffer ends pushes the
+buffer out first, and so does a write through another handle on the
+same file that overlaps it.  Buffers are also written out when they reach the
+chunk size, when the handle is flushed, synced or released, when a read
+overlaps them or runs past the end of the file below them, and when the
+total buffered across all handles goes over the limit.  Buffers follow
+their file through renames.
+
+Errors from deferred writes show up on whatever operation pushed the
+buffer out, usually flush, the same as with the kernel's own write-back.
+"""
+
+import os
+
+from threading import Lock
+
+from gitfs.PosIO import pwrite
+
+
+def writeAll(fd, data, offset):
+    while len(data) > 0:
+        n = pwrite(fd, data, offset)
+        data = data[n:]
+        offset = offset + n
+
+
+class Buffer(object):
+    def __init__(self, fh, path):
+        self.fh = fh
+        self.path = path
+        self.offset = 0
+        self.size = 0
+        self.chunks = []
+        self.lock = Lock()
+
+    def end(self):
+        return self.offset + self.size
+
+    def overlaps(self, offset, size):
+        return self.size > 0 and offset < self.end() and self.offset < offset + size
+
+
+class WriteBuffer(object):
+    def __init__(self, limit, chunk=128*1024, flushed=None):
+        self.limit = limit
+        self.chunk = chunk
+        # called with the path whenever buffered data reaches the file.
+        self.flushed = flushed
+        self.buffers = {} # fh -> Buffer
+        self.paths = {}   # path -> set of fh, so getattr can check cheaply.
+        self.lock = Lock()
+        self.total = 0
+        self.writes = 0
+        self.flushes = 0
+
+    def _buffer(self, fh, path):
+        with self.lock:
+            buf = self.buffers.get(fh)
+            if buf is None:
+                buf = self.buffers[fh] = Buffer(fh, path)
+                self.paths.setdefault(path, set()).add(fh)
+            return buf
+
+    def _account(self, n):
+        with self.lock:
+            self.total = self.total + n
+
+    def _flush(self, buf, upto=None):
+        """Write out buf up to file offset upto, or all of it.  Called with
+        buf.lock held."""
+        if buf.size == 0:
+            return
+        data = ''.join(buf.chunks)
+        n = buf.size
+        if upto is not None:
+            n = upto - buf.offset
+        buf.chunks = []
+        buf.size = 0
+        self._account(-len(data))
+        writeAll(buf.fh, data[:n], buf.offset)
+        self.flushes = self.flushes + 1
+        if self.flushed is not None:
+            self.flushed(buf.path)
+        if n < len(data):
+            buf.offset = buf.offset + n
+            buf.chunks = [data[n:]]
+            buf.size = len(data) - n
+            self._account(buf.size)
+
+    def write(self, fh, path, data, offset):
+        buf = self._buffer(fh, path)
+        if len(self.paths.get(buf.path, ())) > 1:
+            # older data another handle holds there mustn't land on top of this later.
+            for other in self._forPath(buf.path):
+                if other is not buf:
+                    with other.lock:
+                        if other.overlaps(offset, len(data)):
+                            self._flush(other)
+        with buf.lock:
+            self.writes = self.writes + 1
+            if buf.size > 0 and offset != buf.end():
+                self._flush(buf)
+
+            if buf.size == 0 and len(data) >= self.chunk:
+                # already big, nothing to gain by copying it.
+                writeAll(fh, data, offset)
+                return len(data)
+
+            if buf.size == 0:
+                buf.offset = offset
+            buf.chunks.append(data)
+            buf.size = buf.size + len(data)
+            self._account(len(data))
+
+            if buf.size >= self.chunk:
+                # write everything up to the last chunk boundary and keep the tail.
+                self._flush(buf, buf.end() - buf.end() % self.chunk)
+
+        if self.total > self.limit:
+            self.flushAll()
+        return len(data)
+
+    def flushHandle(self, fh):
+        with self.lock:
+            buf = self.buffers.get(fh)
+        if buf is not None:
+            with buf.lock:
+                self._flush(buf)
+
+    def rename(self, old, new):
+        """old, and everything under it, is now called new."""
+        prefix = old + '/'
+        with self.lock:
+            for (path, fhs) in self.paths.items():
+                if path == old or path.startswith(prefix):
+                    moved = new + path[len(old):]
+                    del self.paths[path]
+                    self.paths.setdefault(moved, set()).update(fhs)
+                    for fh in fhs:
+                        self.buffers[fh].path = moved
+
+    def release(self, fh):
+        """Write out and forget the buffer for fh."""
+        with self.lock:
+            buf = self.buffers.pop(fh, None)
+            if buf is not None:
+                fhs = self.paths[buf.path]
+                fhs.discard(fh)
+                if len(fhs) == 0:
+                    del self.paths[buf.path]
+        if buf is not None:
+            with buf.lock:
+                self._flush(buf)
+
+    def _matching(self, match):
+        with self.lock:
+            return [buf for buf in self.buffers.itervalues() if match(buf)]
+
+    def _forPath(self, path):
+        with self.lock:
+            return [self.buffers[fh] for fh in self.paths.get(path, ())]
+
+    def flushRange(self, path, offset, size):
+        """Write out anything buffered for path that overlaps the range,
+        so a read of it sees the data.  Buffers above the range go too if
+        the read runs past the end of the shadow file, the gap below them
+        only reads as zeros once the file is that long."""
+        if path not in self.paths:
+            return
+        for buf in self._forPath(path):
+            with buf.lock:
+                if buf.overlaps(offset, size):
+                    self._flush(buf)
+                elif buf.size > 0 and buf.offset >= offset + size and \
+                        offset + size > os.fstat(buf.fh).st_size:
+                    self._flush(buf)
+
+    def flushPath(self, path):
+        if path not in self.paths:
+            return
+        for buf in self._forPath(path):
+            with buf.lock:
+                self._flush(buf)
+
+    def flushAll(self):
+        for buf in self._matching(lambda b: True):
+            with buf.lock:
+                self._flush(buf)
+
+    def stats(self):
+        return {'limit': self.limit, 'buffered': self.total, 'handles': len(self.buffers),
+                'writes': self.writes, 'flushes': self.flushes}
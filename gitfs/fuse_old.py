@@ -360,16 +360,21 @@ class FUSE(object):
     
     def read(self, path, buf, size, offset, fip):
         fh = fip.contents if self.raw_fi else fip.contents.fh
+        if hasattr(self.operations, 'readinto'):
+            # the operation fills buf itself and says how much it put there.
+            return self.operations('readinto', path, buf, size, offset, fh)
         ret = self.operations('read', path, size, offset, fh)
         if not ret:
             return 0
-        data = create_string_buffer(ret[:size], size)
-        memmove(buf, data, size)
+        size = min(size, len(ret))
+        memmove(buf, ret, size)
         return size
     
     def write(self, path, buf, size, offset, fip):
-        data = string_at(buf, size)
         fh = fip.contents if self.raw_fi else fip.contents.fh
+        if hasattr(self.operations, 'writefrom'):
+            return self.operations('writefrom', path, buf, size, offset, fh)
+        data = string_at(buf, size)
         return self.operations('write', path, data, offset, fh)
     
     def statfs(self, path, buf):
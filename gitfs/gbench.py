@@ -0,0 +1,922 @@
+#!/usr/bin/env python2
+# gbench.py  -*- python -*-
+# Copyright (c) 2013 Ross Biro
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+"""gbench runs benchmarks against the pieces of gitfs that sit on the
+data path.  Each benchmark is a sub command.  By default they work in a
+scratch directory that is removed afterwards, use --directory to point
+them somewhere else, for example inside a mounted gitfs.
+
+    gbench.py rw [--threads 1,2,4,8] [--size MB] [--block KB]
+    gbench.py paths [--depth 4,16,64] [--width 10000]
+    gbench.py [--directory <gitfs dir>] close [--count 200] [--bound ms] [--strict-bound ms]
+    gbench.py durability [--count 2000] [--file-size KB]
+    gbench.py mmap [--size MB] [--block KB] [--rounds 4]
+    gbench.py readdir [--entries 1000,10000,100000] [--baseline-max 10000]
+    gbench.py smallwrite [--size MB] [--block bytes] [<dir> ...]
+    gbench.py readinto [--size MB] [--block 128,1024] [--rounds 8]
+    gbench.py --directory <gitfs dir> handles [--count 2000] [--file-size KB]
+    gbench.py copy [--size MB] [--block KB]
+    gbench.py status [--files 10000] [--changed 1000]
+    gbench.py commit [--files 100000] [--rounds 5]
+    gbench.py backend [--files 100000] [--rounds 5] [--ops 1000]
+    gbench.py stage [--files 5000]
+    gbench.py --directory <gitfs dir> stress [--threads 4,16,64] [--seconds 10]
+"""
+
+import errno
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+from argparse import ArgumentParser
+from ctypes import create_string_buffer, memmove, string_at
+from sys import argv, exit
+from subprocess import PIPE, Popen, call, check_call, check_output
+from threading import Event, Lock, Thread
+from time import time
+
+from gitfs.GitFSBase import GitFSError, GitFSStringMixIn, escapeName, translatePath
+from gitfs.DirLister import listDirectory
+from gitfs.GitBackend import Repo, openBackend
+from gitfs.GitFSClient import GitFSClient
+from gitfs.GitStatus import GitStatus
+from gitfs.GroupSync import GroupSync
+from gitfs.MapCache import MapCache
+from gitfs.PosIO import copyRange, pread, preadinto, pwrite, pwritefrom
+
+
+def parseList(s):
+    return [int(i) for i in s.split(',') if i != '']
+
+def scratchDirectory(cmdline):
+    if cmdline.directory is not None:
+        return tempfile.mkdtemp(prefix='gbench', dir=cmdline.directory)
+    return tempfile.mkdtemp(prefix='gbench')
+
+def makeFile(path, size):
+    block = os.urandom(1024*1024)
+    with open(path, 'wb') as f:
+        while size > 0:
+            f.write(block[:size])
+            size = size - len(block)
+
+def runThreads(count, target, *args):
+    """Start count threads running target(n, *args) and return the
+    number of seconds it took for all of them to finish."""
+    threads = [Thread(target=target, args=(n,) + args) for n in range(count)]
+    start = time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time() - start
+
+def report(name, threads, nbytes, seconds):
+    print '%-24s threads=%-3d %10.1f MB/s' %(name, threads, nbytes / seconds / (1024*1024))
+
+
+class RWBench(object):
+    """Compares the old lseek + read/write under one global lock against
+    positional I/O with no lock at all.  Every thread does the same
+    number of random block sized operations.
+    """
+
+    def __init__(self, directory, size, block, ops):
+        self.directory = directory
+        self.size = size
+        self.block = block
+        self.ops = ops
+        self.lock = Lock()
+        self.paths = []
+
+    def offsets(self, n):
+        r = random.Random(n)
+        blocks = self.size / self.block
+        return [r.randrange(blocks) * self.block for i in range(self.ops)]
+
+    def lockedRead(self, n, fds):
+        fd = fds[n % len(fds)]
+        for offset in self.offsets(n):
+            with self.lock:
+                os.lseek(fd, offset, 0)
+                os.read(fd, self.block)
+
+    def positionalRead(self, n, fds):
+        fd = fds[n % len(fds)]
+        for offset in self.offsets(n):
+            pread(fd, self.block, offset)
+
+    def lockedWrite(self, n, fds):
+        fd = fds[n % len(fds)]
+        data = 'x' * self.block
+        for offset in self.offsets(n):
+            with self.lock:
+                os.lseek(fd, offset, 0)
+                os.write(fd, data)
+
+    def positionalWrite(self, n, fds):
+        fd = fds[n % len(fds)]
+        data = 'x' * self.block
+        for offset in self.offsets(n):
+            pwrite(fd, data, offset)
+
+    def run(self, thread_counts):
+        for threads in thread_counts:
+            while len(self.paths) < threads:
+                path = os.path.join(self.directory, 'rw%d' %len(self.paths))
+                makeFile(path, self.size)
+                self.paths.append(path)
+
+            nbytes = threads * self.ops * self.block
+            # one handle per thread, and every thread sharing a single handle.
+            for shared in (False, True):
+                paths = shared and self.paths[:1] or self.paths[:threads]
+                suffix = shared and ' (shared fh)' or ''
+                fds = [os.open(p, os.O_RDONLY) for p in paths]
+                try:
+                    report('lseek+read' + suffix, threads, nbytes, runThreads(threads, self.lockedRead, fds))
+                    report('pread' + suffix, threads, nbytes, runThreads(threads, self.positionalRead, fds))
+                finally:
+                    for fd in fds:
+                        os.close(fd)
+
+            fds = [os.open(p, os.O_WRONLY) for p in self.paths[:threads]]
+            try:
+                report('lseek+write', threads, nbytes, runThreads(threads, self.lockedWrite, fds))
+                report('pwrite', threads, nbytes, runThreads(threads, self.positionalWrite, fds))
+            finally:
+                for fd in fds:
+                    os.close(fd)
+
+def benchRW(cmdline):
+    directory = scratchDirectory(cmdline)
+    try:
+        b = RWBench(directory, cmdline.size * 1024 * 1024, cmdline.block * 1024, cmdline.ops)
+        b.run(parseList(cmdline.threads))
+    finally:
+        shutil.rmtree(directory)
+
+def recursiveEscape(path):
+    """The original escapePath, kept here as the baseline."""
+    if path == '/' or path == '':
+        return path
+    dir, fil = os.path.split(path)
+    if fil != '.' and fil != '..' and len(fil) > 0 and fil[0] in '@._':
+        fil = '@' + fil
+    return os.path.join(recursiveEscape(dir), fil)
+
+def timePaths(name, paths, translate, rounds):
+    start = time()
+    for i in range(rounds):
+        for p in paths:
+            translate(p)
+    seconds = time() - start
+    print '%-40s %8.2f us/path' %(name, seconds * 1000000 / (rounds * len(paths)))
+
+def benchPaths(cmdline):
+    names = ['src', '.hidden', '_private', '@at', 'README', '__init__.py']
+    mixin = GitFSStringMixIn()
+    sets = []
+    for depth in parseList(cmdline.depth):
+        sets.append(('deep %d' %depth, ['/' + '/'.join(names[(i + n) % len(names)] for i in range(depth))
+                                        for n in range(len(names))]))
+    sets.append(('wide %d' %cmdline.width, ['/a/b/%s%d' %(names[n % len(names)], n) for n in range(cmdline.width)]))
+
+    for (name, paths) in sets:
+        rounds = max(1, cmdline.ops / len(paths))
+        timePaths('%s recursive' %name, paths, recursiveEscape, rounds)
+        timePaths('%s single pass' %name, paths, lambda p: translatePath(p, escapeName), rounds)
+        # warm the cache first so this measures hits.
+        for p in paths:
+            mixin.escapePath(p)
+        timePaths('%s cached' %name, paths, mixin.escapePath, rounds)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def closeLatencies(directory, count):
+    latencies = []
+    data = 'x' * 4096
+    for i in range(count):
+        path = os.path.join(directory, 'close%d' %i)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        os.write(fd, data)
+        start = time()
+        os.close(fd)
+        latencies.append(time() - start)
+        os.unlink(path)
+    return latencies
+
+def reportLatencies(name, latencies):
+    print '%-24s p50=%8.2fms p99=%8.2fms max=%8.2fms' %(name, percentile(latencies, .5) * 1000,
+                                                        percentile(latencies, .99) * 1000, max(latencies) * 1000)
+
+def gitfsCloseLatencies(fs, count):
+    """closeLatencies through GitFS's own create, write, flush and release."""
+    latencies = []
+    data = 'x' * 4096
+    for i in range(count):
+        path = '/close%d' %i
+        fh = fs('create', path, 0644, os.O_WRONLY | os.O_TRUNC)
+        fs('write', path, data, 0, fh)
+        start = time()
+        fs('flush', path, fh)
+        fs('release', path, fh)
+        latencies.append(time() - start)
+        fs('unlink', path)
+    return latencies
+
+def lockedGitFSLatencies(fs, count, hold=5):
+    """gitfsCloseLatencies while another thread holds sync_lock, as
+    _lockWithTimeOut does for a control socket client, for at most hold
+    seconds.  A stand in for the sync thread waits on it like _sync."""
+    held = Event()
+    done = Event()
+    def holder():
+        with fs.sync_lock:
+            held.set()
+            done.wait(hold)
+    def syncer():
+        while not done.is_set():
+            fs.sync_request.wait()
+            fs.sync_request.clear()
+            with fs.sync_lock:
+                pass
+    threads = [Thread(target=holder, args=()), Thread(target=syncer, args=())]
+    threads[0].start()
+    held.wait()
+    threads[1].start()
+    try:
+        return gitfsCloseLatencies(fs, count)
+    finally:
+        done.set()
+        fs.sync_request.set()
+        for t in threads:
+            t.join()
+
+def benchClose(cmdline):
+    """Times close() first with nothing going on and then while the
+    filesystem lock is held, the way gsync holds it for the length of a
+    commit, pull and push.  Inside a gitfs mount it closes real files
+    and takes the lock over the control socket, anywhere else it drives
+    GitFS directly.  Exits with 1 if the locked p99 is more than --bound
+    milliseconds over the idle one, or --strict-bound with --durability
+    strict, where every close waits for an fsync and the disk sets the
+    p99 as much as the lock does."""
+    directory = scratchDirectory(cmdline)
+    try:
+        try:
+            client = GitFSClient.getClientByPath(directory)
+        except GitFSError:
+            client = None
+        if client is not None:
+            idle = closeLatencies(directory, cmdline.count)
+            client.lockRemoteAndHold()
+            try:
+                locked = closeLatencies(directory, cmdline.count)
+            finally:
+                client.unlockRemote()
+        else:
+            # GitFS needs fuse, which none of the other benchmarks do.
+            from gitfs.GitFS import GitFS
+            fs = GitFS.__new__(GitFS)
+            fs.root = directory
+            fs.initOperations(durability=cmdline.durability)
+            try:
+                idle = gitfsCloseLatencies(fs, cmdline.count)
+                locked = lockedGitFSLatencies(fs, cmdline.count)
+            finally:
+                # their threads are daemons, left running they die in the
+                # middle of a wait when the interpreter exits.
+                fs.dirty.stop()
+                fs.dirty.thread.join()
+                if fs.group_sync is not None:
+                    fs.group_sync.stop()
+                    fs.group_sync.thread.join()
+        reportLatencies('close', idle)
+        reportLatencies('close while locked', locked)
+    finally:
+        shutil.rmtree(directory)
+    bound = cmdline.bound
+    if client is None and cmdline.durability == 'strict':
+        bound = cmdline.strict_bound
+    slower = (percentile(locked, .99) - percentile(idle, .99)) * 1000
+    if slower > bound:
+        print 'FAIL: p99 close latency is %.2fms higher while locked, more than %.2fms' %(slower, bound)
+        exit(1)
+
+def benchDurability(cmdline):
+    """Writes and closes a lot of small files, doing on each close what
+    GitFS.flush does in each durability mode."""
+    directory = scratchDirectory(cmdline)
+    data = 'x' * (cmdline.file_size * 1024)
+    try:
+        for mode in ('strict', 'batched', 'relaxed'):
+            group_sync = None
+            if mode == 'batched':
+                group_sync = GroupSync(directory)
+            start = time()
+            for i in range(cmdline.count):
+                fd = os.open(os.path.join(directory, '%s%d' %(mode, i)), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+                os.write(fd, data)
+                if mode == 'strict':
+                    os.fsync(fd)
+                elif mode == 'batched':
+                    group_sync.add(fd)
+                os.close(fd)
+            if group_sync is not None:
+                # the sync thread does this before every commit.
+                group_sync.stop()
+            seconds = time() - start
+            print '%-10s %10.1f files/s' %(mode, cmdline.count / seconds)
+    finally:
+        shutil.rmtree(directory)
+
+def benchMmap(cmdline):
+    """Reads one big file sequentially and at random offsets, once with
+    pread the way GitFS.read always did and once out of a MapCache."""
+    directory = scratchDirectory(cmdline)
+    size = cmdline.size * 1024 * 1024
+    block = cmdline.block * 1024
+    path = os.path.join(directory, 'mmap')
+    try:
+        makeFile(path, size)
+        sequential = range(0, size, block)
+        shuffled = list(sequential)
+        random.Random(0).shuffle(shuffled)
+
+        fd = os.open(path, os.O_RDONLY)
+        cache = MapCache(size, threshold=0)
+        try:
+            cache.opened(path, fd)
+            for (name, offsets) in (('sequential', sequential), ('random', shuffled)):
+                for (how, read) in (('pread', lambda o: pread(fd, block, o)),
+                                    ('mmap', lambda o: cache.read(path, block, o))):
+                    start = time()
+                    for i in range(cmdline.rounds):
+                        for offset in offsets:
+                            read(offset)
+                    report('%s %s' %(name, how), 1, size * cmdline.rounds, time() - start)
+        finally:
+            cache.stop()
+            os.close(fd)
+    finally:
+        shutil.rmtree(directory)
+
+def appendingReaddir(path):
+    """The original GitFS.readdir, kept here as the baseline."""
+    mixin = GitFSStringMixIn()
+    files = os.listdir(path)
+    uefiles = []
+    for file in files:
+        if mixin.isValidPath(file):
+            uefiles = uefiles + [mixin.unescapePath(file)]
+    return [ '.', '..'] + uefiles
+
+def benchReaddir(cmdline):
+    directory = scratchDirectory(cmdline)
+    names = ['src', '.hidden', '_private', '@at', 'README']
+    try:
+        for count in parseList(cmdline.entries):
+            path = os.path.join(directory, 'dir%d' %count)
+            os.mkdir(path)
+            for n in range(count):
+                open(os.path.join(path, escapeName('%s%d' %(names[n % len(names)], n))), 'w').close()
+
+            tests = [('single pass', listDirectory)]
+            if count <= cmdline.baseline_max:
+                tests.insert(0, ('appending', appendingReaddir))
+            for (name, readdir) in tests:
+                start = time()
+                readdir(path)
+                print '%-16s entries=%-8d %10.2f ms' %(name, count, (time() - start) * 1000)
+    finally:
+        shutil.rmtree(directory)
+
+def smallWrites(directory, size, block):
+    path = os.path.join(directory, 'smallwrite')
+    data = 'x' * block
+    start = time()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    try:
+        for i in range(size / block):
+            os.write(fd, data)
+    finally:
+        # the close is where a write-back cache has to catch up.
+        os.close(fd)
+    seconds = time() - start
+    os.unlink(path)
+    return seconds
+
+def benchSmallWrite(cmdline):
+    """Streams a file out in small writes the way compilers and loggers
+    do.  Give it a directory in a mount with writeback_cache and one in a
+    mount without to compare them."""
+    directories = cmdline.directories
+    if len(directories) == 0:
+        directories = [cmdline.directory]
+    size = cmdline.size * 1024 * 1024
+    for directory in directories:
+        cmdline.directory = directory
+        scratch = scratchDirectory(cmdline)
+        try:
+            seconds = smallWrites(scratch, size, cmdline.block)
+            print '%-40s %10.1f MB/s' %(directory or 'scratch', size / seconds / (1024*1024))
+        finally:
+            shutil.rmtree(scratch)
+
+def benchReadInto(cmdline):
+    """Moves a file through a ctypes buffer standing in for the one FUSE
+    hands us, first the way fusepy does it (read a string, copy it in)
+    and then with preadinto/pwritefrom working on the buffer itself."""
+    directory = scratchDirectory(cmdline)
+    size = cmdline.size * 1024 * 1024
+    path = os.path.join(directory, 'readinto')
+    try:
+        makeFile(path, size)
+        fd = os.open(path, os.O_RDWR)
+        try:
+            for kb in parseList(cmdline.block):
+                block = kb * 1024
+                buf = create_string_buffer(block)
+                offsets = range(0, size - block + 1, block)
+
+                def copyRead(offset):
+                    data = pread(fd, block, offset)
+                    memmove(buf, data, len(data))
+
+                def copyWrite(offset):
+                    pwrite(fd, string_at(buf, block), offset)
+
+                tests = (('read string+memmove', copyRead),
+                         ('readinto', lambda o: preadinto(fd, buf, block, o)),
+                         ('write string_at', copyWrite),
+                         ('writefrom', lambda o: pwritefrom(fd, buf, block, o)))
+                for (name, op) in tests:
+                    start = time()
+                    for i in range(cmdline.rounds):
+                        for offset in offsets:
+                            op(offset)
+                    report('%s %dKB' %(name, kb), 1, len(offsets) * block * cmdline.rounds, time() - start)
+        finally:
+            os.close(fd)
+    finally:
+        shutil.rmtree(directory)
+
+def editorSave(directory, n, data):
+    """Write a temporary file next to the original, check it and move it
+    over the original, the way editors save."""
+    path = os.path.join(directory, 'edit%d' %(n % 16))
+    tmp = path + '.tmp'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+    try:
+        os.write(fd, data)
+        os.fstat(fd)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(tmp, path)
+
+def compilerOutput(directory, n, data):
+    """Truncate and rewrite an output file, then read the input again to
+    check it, the way compilers and linkers do."""
+    path = os.path.join(directory, 'out%d' %(n % 16))
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+    try:
+        os.write(fd, data)
+        os.ftruncate(fd, len(data) / 2)
+        os.fstat(fd)
+    finally:
+        os.close(fd)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fstat(fd)
+        os.read(fd, len(data))
+    finally:
+        os.close(fd)
+
+def benchHandles(cmdline):
+    """Common open file patterns that lean on fstat, ftruncate and
+    create with flags.  Inside a gitfs mount these go through the handle
+    instead of the path."""
+    directory = scratchDirectory(cmdline)
+    data = 'x' * (cmdline.file_size * 1024)
+    try:
+        for (name, pattern) in (('editor save', editorSave), ('compiler output', compilerOutput)):
+            start = time()
+            for n in range(cmdline.count):
+                pattern(directory, n, data)
+            print '%-16s %10.1f files/s' %(name, cmdline.count / (time() - start))
+    finally:
+        shutil.rmtree(directory)
+
+def benchCopy(cmdline):
+    """Copies a file the way cp through the mount used to cost us, a read
+    and a write per block in python, and then with copyRange, which is
+    what GitFS.copy_file_range does on the shadow files."""
+    directory = scratchDirectory(cmdline)
+    size = cmdline.size * 1024 * 1024
+    block = cmdline.block * 1024
+    source = os.path.join(directory, 'source')
+    try:
+        makeFile(source, size)
+
+        def readWrite(fd_in, fd_out):
+            for offset in range(0, size, block):
+                pwrite(fd_out, pread(fd_in, block, offset), offset)
+
+        def inKernel(fd_in, fd_out):
+            copyRange(fd_in, 0, fd_out, 0, size)
+
+        for (name, copy) in (('pread+pwrite', readWrite), ('copyRange', inKernel)):
+            fd_in = os.open(source, os.O_RDONLY)
+            fd_out = os.open(os.path.join(directory, 'copy'), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+            try:
+                start = time()
+                cpu = os.times()
+                copy(fd_in, fd_out)
+                cpu = sum(os.times()[:2]) - sum(cpu[:2])
+                seconds = time() - start
+            finally:
+                os.close(fd_in)
+                os.close(fd_out)
+            print '%-16s %10.1f MB/s %8.3fs cpu' %(name, size / seconds / (1024*1024), cpu)
+    finally:
+        shutil.rmtree(directory)
+
+def scrapedStatus(path):
+    """The original GitStatus.update, run three times the way syncNeeded
+    did, kept here as the baseline."""
+    for i in range(3):
+        status = {}
+        for line in os.popen('cd "%s" && git status' %path).readlines():
+            line = line.strip()
+            if line.startswith('#\t'):
+                status.setdefault('untracked', []).append(line[2:].strip())
+
+# so commits work without a configured identity, and no background gc
+# is still running when the repository is removed.
+gitConfig = ['-c', 'user.name=gbench', '-c', 'user.email=gbench@localhost', '-c', 'gc.auto=0']
+
+def makeRepository(directory, files):
+    """A committed repository of files spread over directories of 1000."""
+    for n in range(files):
+        sub = os.path.join(directory, 'd%d' %(n / 1000))
+        if n % 1000 == 0:
+            os.mkdir(sub)
+        with open(os.path.join(sub, 'f%d' %n), 'w') as f:
+            f.write('%d\n' %n)
+    call(['git', 'init', '-q'], cwd=directory)
+    call(['git', 'add', '.'], cwd=directory)
+    call(['git'] + gitConfig + ['commit', '-q', '-m', 'gbench'], cwd=directory)
+
+def benchStatus(cmdline):
+    """Scans a repository with some modified and some untracked files,
+    scraping the human readable output and streaming porcelain v2."""
+    directory = scratchDirectory(cmdline)
+    try:
+        makeRepository(directory, cmdline.files)
+        for n in range(cmdline.changed):
+            # half modified, half new.
+            name = n % 2 and 'f%d' %(n * cmdline.files / cmdline.changed) or 'new%d' %n
+            with open(os.path.join(directory, 'd%d' %(n * cmdline.files / cmdline.changed / 1000), name), 'a') as f:
+                f.write('changed\n')
+
+        # GitStatus moves into the repository, like GitRepo expects.
+        cwd = os.getcwd()
+        status = GitStatus(directory)
+        os.chdir(cwd)
+        for (name, scan) in (('scraped x3', lambda: scrapedStatus(directory)),
+                             ('porcelain v2', status.scan)):
+            start = time()
+            scan()
+            print '%-16s files=%-8d changed=%-6d %10.2f ms' %(name, cmdline.files, cmdline.changed,
+                                                              (time() - start) * 1000)
+    finally:
+        shutil.rmtree(directory)
+
+def porcelainCommit(directory, path, msg):
+    call(['git'] + gitConfig + ['commit', '-q', '-a', '-m', msg], cwd=directory)
+
+def plumbingCommit(directory, path, msg):
+    """What GitRepo.stagePaths and commitIndex run for one changed file."""
+    updater = Popen(['git', 'update-index', '--add', '--remove', '-z', '--stdin'], cwd=directory, stdin=PIPE)
+    updater.communicate(path + '\0')
+    tree = check_output(['git', 'write-tree'], cwd=directory).strip()
+    parent = check_output(['git', 'rev-parse', 'HEAD'], cwd=directory).strip()
+    commit = check_output(['git'] + gitConfig + ['commit-tree', tree, '-p', parent, '-m', msg],
+                          cwd=directory).strip()
+    check_call(['git', 'update-ref', 'HEAD', commit, parent], cwd=directory)
+
+def benchCommit(cmdline):
+    """Commits one changed file in a big repository, with commit -a and
+    with the plumbing GitRepo uses for targeted syncs."""
+    directory = scratchDirectory(cmdline)
+    try:
+        makeRepository(directory, cmdline.files)
+        path = os.path.join('d0', 'f0')
+        for (name, commit) in (('commit -a', porcelainCommit), ('plumbing', plumbingCommit)):
+            times = []
+            for i in range(cmdline.rounds):
+                with open(os.path.join(directory, path), 'a') as f:
+                    f.write('%s %d\n' %(name, i))
+                start = time()
+                commit(directory, path, '%s %d' %(name, i))
+                times.append(time() - start)
+            print '%-12s files=%-8d %10.2f ms median' %(name, cmdline.files, percentile(times, .5) * 1000)
+    finally:
+        shutil.rmtree(directory)
+
+def benchBackend(cmdline):
+    """Runs the operations GitRepo needs through each git backend in a
+    big repository: reading HEAD, writing and reading blobs, diffing two
+    commits, and staging and committing one changed file."""
+    directory = scratchDirectory(cmdline)
+    try:
+        makeRepository(directory, cmdline.files)
+        # the backends commit with the repository's identity.
+        call(['git', 'config', 'user.name', 'gbench'], cwd=directory)
+        call(['git', 'config', 'user.email', 'gbench@localhost'], cwd=directory)
+        call(['git', 'config', 'gc.auto', '0'], cwd=directory)
+        names = ['cli']
+        if Repo is not None:
+            names.append('dulwich')
+        path = os.path.join('d0', 'f0')
+        for name in names:
+            backend = openBackend(directory, name)
+            start = time()
+            for i in range(cmdline.ops):
+                backend.head()
+            print '%-8s head         %10.3f ms/op' %(name, (time() - start) * 1000 / cmdline.ops)
+            start = time()
+            for i in range(cmdline.ops):
+                backend.readBlob(backend.writeBlob('%s %d\n' %(name, i)))
+            print '%-8s blob w+r     %10.3f ms/op' %(name, (time() - start) * 1000 / cmdline.ops)
+
+            first = backend.head()
+            times = []
+            for i in range(cmdline.rounds):
+                with open(os.path.join(directory, path), 'a') as f:
+                    f.write('%s %d\n' %(name, i))
+                start = time()
+                backend.stagePaths([path])
+                tree = backend.writeTree()
+                parent = backend.head()
+                backend.updateRef('HEAD', backend.commitTree(tree, [parent], '%s %d' %(name, i)), parent, name)
+                times.append(time() - start)
+            print '%-8s commit       %10.2f ms median files=%d' %(name, percentile(times, .5) * 1000, cmdline.files)
+            start = time()
+            backend.changedPaths(first, backend.head())
+            print '%-8s diff commits %10.2f ms' %(name, (time() - start) * 1000)
+    finally:
+        shutil.rmtree(directory)
+
+def benchStage(cmdline):
+    """Stages a FIFO, which git refuses, ahead of more new files than
+    fit in a pipe buffer, the way GitRepo.synchronize does after a
+    build.  update-index quits at the FIFO without reading the rest.
+    Exits with 1 unless the FIFO alone is left out and every file is
+    staged."""
+    # GitRepo needs fuse, which none of the other benchmarks do.
+    from gitfs.GitFS import GitRepo
+    directory = scratchDirectory(cmdline)
+    try:
+        call(['git', 'init', '-q'], cwd=directory)
+        os.mkfifo(os.path.join(directory, 'fifo'))
+        paths = ['fifo']
+        os.mkdir(os.path.join(directory, 'build'))
+        for n in range(cmdline.files):
+            path = os.path.join('build', 'object%d.o' %n)
+            with open(os.path.join(directory, path), 'w') as f:
+                f.write('%d\n' %n)
+            paths.append(path)
+        repo = GitRepo.__new__(GitRepo)
+        repo.backend = openBackend(directory, 'cli')
+        start = time()
+        skipped = repo.stageOrSkip(paths)
+        print '%-8s files=%-8d %10.2f ms skipped=%s' %('stage', cmdline.files, (time() - start) * 1000,
+                                                       ','.join(skipped))
+        staged = len([p for p in check_output(['git', 'ls-files', '-z'], cwd=directory).split('\0') if p != ''])
+    finally:
+        shutil.rmtree(directory)
+    if skipped != ['fifo'] or staged != cmdline.files:
+        print 'FAIL: staged %d of %d files, skipped %s' %(staged, cmdline.files, skipped)
+        exit(1)
+
+class StressBench(object):
+    """Creators, renamers, writers and mkdir/rmdir all working in one
+    directory at the same time, on names they share, the way a parallel
+    build or checkout would.  Collisions are expected and the errors they
+    give (ENOENT, EEXIST, ENOTEMPTY) are counted as misses.  Anything else
+    is a failure, and so is a file that ends up holding a torn block.
+    """
+
+    # errors two operations racing for the same name can legitimately get.
+    expected = (errno.ENOENT, errno.EEXIST, errno.ENOTEMPTY)
+
+    def __init__(self, directory, names, block):
+        self.directory = directory
+        self.names = names
+        self.block = block
+        self.lock = Lock()
+        self.ops = 0
+        self.misses = 0
+        self.failures = []
+        self.stop_at = 0
+
+    def name(self, r, prefix):
+        return os.path.join(self.directory, '%s%d' %(prefix, r.randrange(self.names)))
+
+    def creator(self, r):
+        path = self.name(r, 'f')
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0644)
+        try:
+            os.write(fd, chr(ord('a') + r.randrange(26)) * self.block)
+        finally:
+            os.close(fd)
+        if r.randrange(4) == 0:
+            os.unlink(path)
+
+    def renamer(self, r):
+        os.rename(self.name(r, 'f'), self.name(r, 'f'))
+
+    def writer(self, r):
+        fd = os.open(self.name(r, 'f'), os.O_WRONLY)
+        try:
+            pwrite(fd, chr(ord('a') + r.randrange(26)) * self.block, r.randrange(4) * self.block)
+        finally:
+            os.close(fd)
+
+    def directories(self, r):
+        path = self.name(r, 'd')
+        if r.randrange(2) == 0:
+            os.mkdir(path)
+        else:
+            os.rmdir(path)
+
+    def worker(self, n):
+        r = random.Random(n)
+        work = (self.creator, self.renamer, self.writer, self.directories)[n % 4]
+        ops = misses = 0
+        while time() < self.stop_at:
+            try:
+                work(r)
+                ops = ops + 1
+            except EnvironmentError as e:
+                if e.errno not in self.expected:
+                    with self.lock:
+                        self.failures.append('%s: %s' %(work.__name__, e))
+                    break
+                misses = misses + 1
+        with self.lock:
+            self.ops = self.ops + ops
+            self.misses = self.misses + misses
+
+    def check(self):
+        """Every block of every file should come from a single write."""
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.startswith('f'):
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            for offset in range(0, len(data), self.block):
+                chunk = data[offset:offset + self.block]
+                if chunk.strip(chunk[0]) != '':
+                    self.failures.append('%s has a torn block at %d' %(name, offset))
+                    break
+
+    def run(self, threads, seconds):
+        self.ops = self.misses = 0
+        self.stop_at = time() + seconds
+        elapsed = runThreads(threads, self.worker)
+        self.check()
+        print '%-10s threads=%-3d %10.1f ops/s %8d misses %4d failures' %(
+            'stress', threads, self.ops / elapsed, self.misses, len(self.failures))
+        for failure in self.failures:
+            print '    %s' %failure
+        self.failures = []
+
+def benchStress(cmdline):
+    """Point --directory inside a gitfs mount, ideally one mounted with
+    a threads option, to exercise its per path locking."""
+    directory = scratchDirectory(cmdline)
+    try:
+        b = StressBench(directory, cmdline.names, cmdline.block)
+        for threads in parseList(cmdline.threads):
+            b.run(threads, cmdline.seconds)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    parser = ArgumentParser(description='benchmark the gitfs data path.')
+    parser.add_argument('--directory', default=None)
+    subparsers = parser.add_subparsers()
+
+    p = subparsers.add_parser('rw', help='positional vs locked reads and writes')
+    p.add_argument('--threads', default='1,2,4,8')
+    p.add_argument('--size', type=int, default=64, help='file size in MB')
+    p.add_argument('--block', type=int, default=64, help='block size in KB')
+    p.add_argument('--ops', type=int, default=2000, help='operations per thread')
+    p.set_defaults(func=benchRW)
+
+    p = subparsers.add_parser('paths', help='escape path translation')
+    p.add_argument('--depth', default='4,16,64')
+    p.add_argument('--width', type=int, default=10000)
+    p.add_argument('--ops', type=int, default=100000, help='translations per test')
+    p.set_defaults(func=benchPaths)
+
+    p = subparsers.add_parser('close', help='close() latency while the filesystem is locked')
+    p.add_argument('--count', type=int, default=200)
+    p.add_argument('--bound', type=float, default=2.0, help='how many ms the locked p99 may add')
+    p.add_argument('--strict-bound', type=float, default=20.0, help='--bound for --durability strict')
+    p.add_argument('--durability', default='relaxed', help='durability mode when driving GitFS directly')
+    p.set_defaults(func=benchClose)
+
+    p = subparsers.add_parser('durability', help='small file throughput in each durability mode')
+    p.add_argument('--count', type=int, default=2000)
+    p.add_argument('--file-size', '--file_size', type=int, default=4, help='file size in KB')
+    p.set_defaults(func=benchDurability)
+
+    p = subparsers.add_parser('mmap', help='reads out of a mapping vs pread')
+    p.add_argument('--size', type=int, default=256, help='file size in MB')
+    p.add_argument('--block', type=int, default=128, help='read size in KB')
+    p.add_argument('--rounds', type=int, default=4, help='passes over the file')
+    p.set_defaults(func=benchMmap)
+
+    p = subparsers.add_parser('readdir', help='listing big directories')
+    p.add_argument('--entries', default='1000,10000,100000')
+    p.add_argument('--baseline-max', '--baseline_max', type=int, default=10000,
+                   help='largest directory to run the quadratic original on')
+    p.set_defaults(func=benchReaddir)
+
+    p = subparsers.add_parser('smallwrite', help='small write throughput, e.g. with and without writeback_cache')
+    p.add_argument('--size', type=int, default=64, help='file size in MB')
+    p.add_argument('--block', type=int, default=4096, help='write size in bytes')
+    p.add_argument('directories', nargs='*', help='directories to compare, defaults to --directory')
+    p.set_defaults(func=benchSmallWrite)
+
+    p = subparsers.add_parser('readinto', help='reading into and writing from a caller buffer vs strings')
+    p.add_argument('--size', type=int, default=64, help='file size in MB')
+    p.add_argument('--block', default='128,1024', help='block sizes in KB')
+    p.add_argument('--rounds', type=int, default=8, help='passes over the file')
+    p.set_defaults(func=benchReadInto)
+
+    p = subparsers.add_parser('handles', help='editor and compiler file patterns that use open handles')
+    p.add_argument('--count', type=int, default=2000)
+    p.add_argument('--file-size', '--file_size', type=int, default=16, help='file size in KB')
+    p.set_defaults(func=benchHandles)
+
+    p = subparsers.add_parser('copy', help='copying through python vs copy_file_range')
+    p.add_argument('--size', type=int, default=256, help='file size in MB')
+    p.add_argument('--block', type=int, default=128, help='read size in KB for the python copy')
+    p.set_defaults(func=benchCopy)
+
+    p = subparsers.add_parser('status', help='scraping git status vs streaming porcelain v2')
+    p.add_argument('--files', type=int, default=10000, help='files in the repository')
+    p.add_argument('--changed', type=int, default=1000, help='files modified or added')
+    p.set_defaults(func=benchStatus)
+
+    p = subparsers.add_parser('commit', help='commit -a vs plumbing for one changed file')
+    p.add_argument('--files', type=int, default=100000, help='files in the repository')
+    p.add_argument('--rounds', type=int, default=5, help='commits of each kind')
+    p.set_defaults(func=benchCommit)
+
+    p = subparsers.add_parser('backend', help='the git command line vs dulwich in process')
+    p.add_argument('--files', type=int, default=100000, help='files in the repository')
+    p.add_argument('--rounds', type=int, default=5, help='commits with each backend')
+    p.add_argument('--ops', type=int, default=1000, help='head and blob operations with each backend')
+    p.set_defaults(func=benchBackend)
+
+    p = subparsers.add_parser('stage', help='staging a batch git refuses part of')
+    p.add_argument('--files', type=int, default=5000, help='files staged after the one git refuses')
+    p.set_defaults(func=benchStage)
+
+    p = subparsers.add_parser('stress', help='concurrent creators, renamers and writers on shared names')
+    p.add_argument('--threads', default='4,16,64')
+    p.add_argument('--seconds', type=int, default=10, help='how long each run lasts')
+    p.add_argument('--names', type=int, default=32, help='how many names the threads fight over')
+    p.add_argument('--block', type=int, default=4096, help='write size in bytes')
+    p.set_defaults(func=benchStress)
+
+    cmdline = parser.parse_args(argv[1:])
+    cmdline.func(cmdline)
@@ -25,8 +25,8 @@ is the same one with a . prepended.  When there is a mkgitfs, it will
 need to make sure all of the assumptions gmount and GitFS make are
 respected.
 """
-from fuse import FUSE
 from gitfs.GitFSBase import GitFSError
+from gitfs.GitFUSE import GitFUSE
 
 import os
 import logging
@@ -153,14 +153,29 @@ def mount(device, mount_point, options):
         branch = options['branch']
         del options['branch']
 
+    # pull out the options that are meant for GitFS rather than FUSE.
+    gitfs_options = {}
+    for key in GitFS.GitFS.option_defaults:
+        if key in options:
+            gitfs_options[key] = options[key]
+            del options[key]
+
     if 'verbose' in options:
         print ('mounting %s on %s with options %s' %(device, mount_point, options))
 
     if 'debug' not in options:
         logging.debug ('mounting %s on %s with options %s' %(device, mount_point, options))
-        gitfs = GitFS.GitFS(origin, branch, device, mount_point)
+        gitfs = GitFS.GitFS(origin, branch, device, mount_point, **gitfs_options)
+        # the kernel cache settings are defaults, anything in fstab or on the command line wins.
+        fuse_options = gitfs.mountOptions()
+        fuse_options.update(options)
+        mounter = GitFUSE
+        if gitfs.flagOption('lowlevel'):
+            # only loaded when asked for, it needs more of libfuse than fusepy does.
+            from gitfs.LowLevel import LowLevel
+            mounter = LowLevel
         try:
-            fuse = FUSE(gitfs, mount_point, **options)
+            fuse = mounter(gitfs, mount_point, **fuse_options)
         finally:
             gitfs.destroy(None)
 
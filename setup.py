@@ -20,6 +20,8 @@ setup(
     version=str(Changelog(changelog).version),
     packages=find_packages(),
     install_requires=requirements,
+    # DirLister lists directories faster with it, python 3.5+ has it built in.
+    extras_require={'scandir': ['scandir']},
     author='Alex Rembish',
     author_email='alex@rembish.org'
 )